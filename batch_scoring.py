@@ -0,0 +1,83 @@
+# Headless batch scoring of shelter exports without the Streamlit app.
+# The input CSV is read in fixed-size chunks, each chunk is cleaned and scored with the same
+# functions the app uses, and the scored rows are appended to the output CSV, so memory use
+# depends on the chunk size and not on the size of the export.
+#
+# Usage: python batch_scoring.py shelter_export.csv scored_export.csv --chunksize 100000 --workers 8
+import argparse
+import logging
+import os
+import time
+import warnings
+
+import pandas as pd
+
+import data_functions as dip
+
+
+def score_chunk(chunk, workers=1):
+    # Same pipeline as the Getting Started and Animal Adoption Prediction pages
+    if workers > 1:
+        cleaned_data, _ = dip.run_parallel_preprocessing(chunk, workers=workers)
+    else:
+        cleaned_data, _ = dip.run_preprocessing_stages(chunk)
+    if cleaned_data.empty:
+        return cleaned_data
+    return dip.adoption_prediction(cleaned_data)
+
+
+def batch_scoring(input_path, output_path, chunksize=100_000, workers=1):
+    columns = pd.read_csv(input_path, nrows=0).columns
+    missing_vars = [var for var in dip.RELEVANT_VARS if var not in columns]
+    if missing_vars:
+        raise ValueError(f'The following relevant variables are missing in {input_path}: {", ".join(missing_vars)}')
+
+    # Start from an empty output file, chunks are appended as they are scored
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    rows_read = 0
+    rows_scored = 0
+    start_time = time.perf_counter()
+
+    for chunk_num, chunk in enumerate(pd.read_csv(input_path, usecols=dip.upload_columns(columns), dtype=str, chunksize=chunksize), start=1):
+        rows_read += len(chunk)
+        scored_chunk = score_chunk(chunk, workers)
+
+        if not scored_chunk.empty:
+            scored_chunk = dip.flags_to_yes_no(scored_chunk)
+            scored_chunk.to_csv(output_path, mode='a', header=rows_scored == 0, index=False)
+            rows_scored += len(scored_chunk)
+
+        print(f'Chunk {chunk_num}: {rows_read} rows read, {rows_scored} rows scored ({time.perf_counter() - start_time:.1f}s)')
+
+    dip.flush_prediction_cache()
+    return {'rows_read': rows_read, 'rows_scored': rows_scored, 'seconds': round(time.perf_counter() - start_time, 3),
+            'prediction_cache': dip.get_prediction_cache_stats()}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Clean and score a shelter export in fixed-size chunks.')
+    arg_parser.add_argument('input_path', help='CSV export with the relevant variables')
+    arg_parser.add_argument('output_path', help='CSV file to write the scored rows to')
+    arg_parser.add_argument('--chunksize', type=int, default=100_000, help='number of rows to read, clean and score at a time')
+    arg_parser.add_argument('--workers', type=int, default=1, help='number of processes to clean each chunk with')
+    args = arg_parser.parse_args()
+
+    # Session state is not available outside `streamlit run`, so silence its warnings
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
+
+    encoding_warning = dip.get_encoding_vocabulary_warning()
+    if encoding_warning:
+        print(f'Warning: {encoding_warning}')
+
+    summary = batch_scoring(args.input_path, args.output_path, args.chunksize, args.workers)
+    print(f"Done: {summary['rows_scored']} of {summary['rows_read']} rows scored in {summary['seconds']}s, written to {args.output_path}")
+    prediction_cache = summary['prediction_cache']
+    if prediction_cache['lookups']:
+        print(f"Prediction cache: {prediction_cache['hits']} of {prediction_cache['lookups']} rows scored from the cache ({prediction_cache['hit_rate']:.1%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# End-to-end benchmark of the cleaning, prediction and dashboard pipeline on synthetic shelter data.
+# For every dataset size a seeded synthetic file is generated (and reused on later runs), then each stage is
+# run in turn, from change_date_data_type through transform_data, adoption_prediction and the dashboard
+# aggregates, recording its wall-clock time, rows in and out, and the peak memory allocated while it ran.
+# The results are written as JSON so runs can be compared over time.
+#
+# Usage: python benchmark_pipeline.py --rows 10000 100000 1000000 --output benchmark_results.json
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+import data_functions as dip
+import shelter_data_generator as generator
+
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000]
+BENCHMARK_DATA_DIR = os.path.join(dip.ARTIFACT_DIR, '.shelter_cache', 'benchmark_data')
+
+
+def initial_sort(data):
+    return data.sort_values(by=dip.SORT_COLUMNS, ascending=dip.SORT_ASCENDING)
+
+def initial_filter(data):
+    return dip.filter_valid_records(data).reset_index(drop=True)
+
+def dashboard_aggregates(data):
+    return dip.build_metrics_cube(data)
+
+def prediction_filter_index(data):
+    dip.build_filter_index(data)
+    return data
+
+# The steps of initial_preprocessing are timed one by one, the later stages take the output of the stage before,
+# except the dashboard aggregates which are built from the cleaned data
+BENCHMARK_STAGES = [
+    ('read_upload', None),
+    ('change_date_data_type', dip.change_date_data_type),
+    ('sort', initial_sort),
+    ('remove_missing_data', dip.remove_missing_data),
+    ('filter_valid_records', initial_filter),
+    ('data_transformation', dip.data_transformation),
+    ('transform_data', dip.transform_data),
+    ('dashboard_aggregates', dashboard_aggregates),
+    ('adoption_prediction', dip.adoption_prediction),
+    ('build_filter_index', prediction_filter_index),
+]
+
+
+def get_benchmark_file(num_rows, seed):
+    os.makedirs(BENCHMARK_DATA_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DATA_DIR, f'synthetic_{num_rows}_seed{seed}.csv')
+    if not os.path.exists(path):
+        start_time = time.perf_counter()
+        generator.write_shelter_data(path, num_rows, seed)
+        print(f'Generated {num_rows} rows in {time.perf_counter() - start_time:.1f}s: {path}')
+    return path
+
+def run_stage(stage_function, data, track_memory):
+    if track_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    output = stage_function(data)
+    seconds = time.perf_counter() - start_time
+    peak_bytes = None
+    if track_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return output, seconds, peak_bytes
+
+# Run every stage once on the file, returning (stage, seconds, rows in, rows out, peak bytes) per stage and the cleaned data
+def run_stages(path, track_memory):
+    def read_upload(_):
+        with open(path, 'rb') as f:
+            return dip.read_csv_columns(f, dip.upload_columns(pd.read_csv(path, nrows=0).columns))
+
+    stage_results = []
+    data = None
+    cleaned_data = None
+    for stage_name, stage_function in BENCHMARK_STAGES:
+        stage_input = cleaned_data if stage_name == 'dashboard_aggregates' else data
+        rows_in = 0 if stage_input is None else len(stage_input)
+
+        output, seconds, peak_bytes = run_stage(stage_function or read_upload, stage_input, track_memory)
+        if stage_name == 'transform_data':
+            cleaned_data = output
+        if stage_name != 'dashboard_aggregates':
+            data = output
+        stage_results.append((stage_name, seconds, rows_in, len(output), peak_bytes))
+
+    return stage_results, cleaned_data
+
+# Stages are timed in one run, and their peak memory is measured in a second run because
+# tracing every allocation slows the stages down several times
+def benchmark_size(num_rows, seed=0, track_memory=True):
+    path = get_benchmark_file(num_rows, seed)
+
+    stage_results, cleaned_data = run_stages(path, track_memory=False)
+    peak_memory = [None] * len(stage_results)
+    if track_memory:
+        del cleaned_data
+        traced_results, cleaned_data = run_stages(path, track_memory=True)
+        peak_memory = [peak_bytes for _, _, _, _, peak_bytes in traced_results]
+
+    results = []
+    for (stage_name, seconds, rows_in, rows_out, _), peak_bytes in zip(stage_results, peak_memory):
+        results.append({
+            'rows': num_rows,
+            'stage': stage_name,
+            'seconds': round(seconds, 4),
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'peak_memory_mb': None if peak_bytes is None else round(peak_bytes / 1024 ** 2, 1),
+        })
+        print(f"{num_rows:>10} rows  {stage_name:<22} {seconds:8.3f}s  {rows_in:>10} -> {rows_out:<10}"
+              + ('' if peak_bytes is None else f' peak {peak_bytes / 1024 ** 2:8.1f} MB'))
+
+    results.append({
+        'rows': num_rows,
+        'stage': 'total',
+        'seconds': round(sum(result['seconds'] for result in results), 4),
+        'rows_in': num_rows,
+        'rows_out': stage_results[-1][3],
+        'peak_memory_mb': None,
+        'cleaned_memory_per_row': round(dip.memory_per_row(cleaned_data), 1),
+    })
+    return results
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=dip.ARTIFACT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(row_counts, seed=0, track_memory=True):
+    results = []
+    for num_rows in row_counts:
+        results.extend(benchmark_size(num_rows, seed, track_memory))
+
+    return {
+        'run': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_commit': get_git_commit(),
+            'pipeline_version': dip.PIPELINE_VERSION,
+            'seed': seed,
+            'memory_tracked': track_memory,
+            'prediction_cache': dip.PREDICTION_CACHE_ENABLED,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the shelter data pipeline on synthetic datasets.')
+    arg_parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help='dataset sizes to benchmark, e.g. 10000 100000 1000000 10000000')
+    arg_parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic datasets')
+    arg_parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write the results to')
+    arg_parser.add_argument('--no-memory', action='store_true', help='skip the second run that measures peak memory')
+    arg_parser.add_argument('--prediction-cache', action='store_true', help='score from the prediction cache, so repeated runs time cache hits')
+    args = arg_parser.parse_args()
+
+    # Session state is not available outside `streamlit run`, so silence its warnings
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
+
+    # Every run times the model unless asked otherwise, the second run and later benchmarks would hit the cache
+    dip.PREDICTION_CACHE_ENABLED = args.prediction_cache
+    benchmark = run_benchmark(args.rows, args.seed, track_memory=not args.no_memory)
+    with open(args.output, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+# Build the snapshot the Analytics Dashboard shows in sample mode.
+# The bundled sample dataset is cleaned once and its KPI accumulator and metrics cube are saved next to the app,
+# so the demo dashboard renders without reading or cleaning any rows.
+# Rerun this whenever testing_sample_data.csv or the cleaning pipeline changes.
+#
+# Usage: python build_sample_snapshot.py
+import logging
+import time
+import warnings
+
+import pandas as pd
+
+import data_functions as dip
+
+
+def main():
+    # Session state is not available outside `streamlit run`, so silence its warnings
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
+
+    start_time = time.perf_counter()
+    snapshot = dip.save_sample_dashboard_snapshot()
+    print(f"Snapshot of {dip.SAMPLE_DATASET_PATH} written to {dip.SAMPLE_SNAPSHOT_PATH} in {time.perf_counter() - start_time:.1f}s")
+    print(f"KPIs: {dip.kpi_totals(snapshot['kpi_accumulator'])}, metrics cube: {len(snapshot['cube'])} rows")
+
+
+if __name__ == '__main__':
+    main()
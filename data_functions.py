@@ -4,31 +4,74 @@ import pandas as pd
 import numpy as np
 import time
 import re
-import base64
+import os
+import hashlib
+import json
+import threading
+import multiprocessing
+import logging
+import warnings
+import datetime
+import io
+import weakref
+from collections import OrderedDict
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import uuid
 import plotly.express as px
 import plotly.graph_objects as go
-import time
-from joblib import load
+from joblib import load, dump
 from dateutil import parser
-from sklearn.preprocessing import LabelEncoder
+import profiling
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+
+# Artifacts and caches are found next to this file so scripts can run from any directory
+ARTIFACT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The sample dataset ships with the app, it is only downloaded when SHELTER_SAMPLE_DATASET_URL is set
+# (e.g. to https://raw.githubusercontent.com/ZhiYing1112/fyp-animal-shelter-analytics-dashboard/main/testing_sample_data.csv)
+SAMPLE_DATASET_PATH = os.path.join(ARTIFACT_DIR, 'testing_sample_data.csv')
+SAMPLE_DATASET_URL = os.environ.get('SHELTER_SAMPLE_DATASET_URL')
 
+# Variables the uploaded dataset must have
+RELEVANT_VARS = ['animal_id', 'animal_type', 'age', 'breed', 'colour', 'gender', 'outcome_type', 'intake_type', 'intake_date_time', 'outcome_date_time']
+
+# Columns read when the upload has them, intake_condition is used by the prediction model
+OPTIONAL_UPLOAD_VARS = ['intake_condition']
 
 def upload_file_and_check_variables():
     
-    uploaded_file = st.file_uploader('Choose and submit a single file (only .csv file is accepted)',
-                                      type=['csv'], 
+    uploaded_file = st.file_uploader('Choose and submit a single file (.csv or .xlsx file is accepted)',
+                                      type=['csv', 'xlsx'], 
                                       accept_multiple_files=False)
 
     if uploaded_file is not None:
         try:
-            data = pd.read_csv(uploaded_file)
+            # The page reruns while a cleaning job runs, so the parsed upload is reused until another file is uploaded
+            data = get_parsed_upload(uploaded_file.id)
+            if data is not None:
+                st.success('Great! Your dataset has all the relevant variables for this program.')
+                return data
 
-            # Check if relevant variables are present in the dataset
-            relevant_vars = ['animal_id', 'animal_type', 'age', 'breed', 'colour', 'gender', 'outcome_type', 'intake_type', 'intake_date_time', 'outcome_date_time']
-            
-            missing_vars = [var for var in relevant_vars if var not in data.columns]
+            # Hash of the uploaded bytes, used to look up the cleaned data in the cache
+            upload_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            st.session_state['uploaded_file_hash'] = upload_hash
+
+            # Check if relevant variables are present in the dataset, before any rows are parsed
+            columns = read_upload_header(uploaded_file, uploaded_file.name)
+            missing_vars = [var for var in RELEVANT_VARS if var not in columns]
 
             if len(missing_vars) == 0:
+                # The same file uploaded in another session is parsed only once
+                upload_key = f'upload-{upload_hash}'
+                data = get_dataset(upload_key)
+                if data is None:
+                    data = read_upload(uploaded_file, uploaded_file.name, upload_columns(columns))
+                    put_dataset(data, upload_key)
+                st.session_state['parsed_upload'] = {'file_id': uploaded_file.id, 'dataset_key': upload_key}
                 st.success('Great! Your dataset has all the relevant variables for this program.')
                 return data
             
@@ -36,81 +79,1019 @@ def upload_file_and_check_variables():
                 st.error(f'The following relevant variables are missing in the dataset: {", ".join(missing_vars)}. Please try again.')
 
         except Exception as e:
-            st.error('Error: Unable to read the uploaded file. Please make sure it is a valid CSV file.')
+            st.error('Error: Unable to read the uploaded file. Please make sure it is a valid CSV or Excel file.')
             st.error(e)
     else:
         st.warning('Please upload a file to continue.')
 
+# The parsed upload of this session from the dataset store, if the uploaded file is still the same one
+def get_parsed_upload(file_id):
+    parsed_upload = st.session_state.get('parsed_upload')
+    if parsed_upload is None or parsed_upload['file_id'] != file_id:
+        return None
+    return get_dataset(parsed_upload['dataset_key'])
+
+# Only the relevant (and optional) columns are read, the rest of the file is skipped
+def upload_columns(columns):
+    return [col for col in columns if col in RELEVANT_VARS or col in OPTIONAL_UPLOAD_VARS]
+
+def is_excel_file(file_name):
+    return str(file_name).lower().endswith('.xlsx')
+
+def read_upload_header(file, file_name):
+    if is_excel_file(file_name):
+        with open_excel_sheet(file) as rows:
+            header = next(rows, ())
+        return [str(col) for col in header if col is not None]
+
+    header = pd.read_csv(file, nrows=0).columns.tolist()
+    file.seek(0)
+    return header
+
+def read_upload(file, file_name, columns):
+    if is_excel_file(file_name):
+        return read_excel_columns(file, columns)
+    return read_csv_columns(file, columns)
+
+# Every column is read as text, the pipeline parses dates and ages itself.
+# The pyarrow reader parses blocks of the file on several threads.
+def read_csv_columns(file, columns):
+    convert_options = pacsv.ConvertOptions(
+        include_columns=columns,
+        column_types={col: pa.string() for col in columns},
+        strings_can_be_null=True,
+    )
+    data = pacsv.read_csv(file, convert_options=convert_options).to_pandas()
+    file.seek(0)
+    return data
 
-# Create a function that accesses the data from the session state and preprocesses it
+# Stream the rows of the first sheet without loading the whole workbook into memory
+@contextmanager
+def open_excel_sheet(file):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportError('Reading .xlsx files needs the openpyxl package, install it with "pip install openpyxl"')
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def read_excel_columns(file, columns):
+    with open_excel_sheet(file) as rows:
+        header = [None if col is None else str(col) for col in next(rows, ())]
+        positions = [header.index(col) for col in columns]
+        records = [[row[i] if i < len(row) else None for i in positions] for row in rows]
+    file.seek(0)
+
+    data = pd.DataFrame(records, columns=columns, dtype=object)
+
+    # Blank trailing rows are common in spreadsheets
+    data = data.dropna(how='all').reset_index(drop=True)
+
+    # Date cells come back as datetimes, everything else is read as text like the CSV reader does
+    for col in columns:
+        values = data[col]
+        if values.notnull().any() and values.dropna().map(lambda value: isinstance(value, datetime.datetime)).all():
+            data[col] = pd.to_datetime(values)
+        else:
+            data[col] = values.where(values.isnull(), values.astype(str))
+    return data
 
-def data_preprocessing(data):
-    
-    if data is not None:
-        progress_bar = st.progress(0)
-        status_text = st.empty()
 
-        initial_cleaning_data = initial_preprocessing(data)
-        transformed_data = data_transformation(initial_cleaning_data)
-        final_data = transform_data(transformed_data)
-        
+# Cleaning an upload runs as a background job (see submit_job), so the page stays responsive and the user
+# can cancel it. The job works without the session state: it returns the cleaned dataset's key in the
+# dataset store and the session values, and the page hands them to the session when the job is done.
+def clean_upload_job(job, data, upload_hash=None):
+    # Reuse the cleaned data if the same file has been cleaned before
+    cache_key = cleaned_data_cache_key(upload_hash) if upload_hash is not None else None
+    if cache_key is not None:
+        cached = load_cleaned_data_from_cache(cache_key)
+        if cached is not None:
+            final_data, metadata, intake_ledger = cached
+            # Entries saved before the metrics were left out of the metadata hold them as null, so only the cached keys are used
+            session_values = {key: metadata[key] for key in CACHED_SESSION_STATE_KEYS if key in metadata}
+            session_values.update(intake_ledger=intake_ledger, kpi_accumulator=build_kpi_accumulator(intake_ledger))
+            return {'dataset_key': put_dataset(final_data), 'session': session_values, 'from_cache': True}
+
+    def show_partition_progress(partitions_done, num_partitions):
+        report_job_progress(job, 0.9 * partitions_done / num_partitions, f'Preprocessing data: {partitions_done}/{num_partitions} partitions cleaned')
+
+    final_data, stage_timings, session_values = partitioned_preprocessing(data, on_partition_complete=show_partition_progress,
+                                                                         partition_size=job_partition_size(len(data)), cancel_event=job_cancel_event(job))
+    report_job_progress(job, 0.95, 'Saving the cleaned data')
+
+    # Keep the stage timings so we can see where preprocessing time goes
+    session_values['preprocessing_timings'] = stage_timings
+    session_values['cleaned_memory_per_row'] = memory_per_row(final_data)
+
+    if cache_key is not None:
+        metadata = {key: session_values.get(key) for key in CACHED_SESSION_STATE_KEYS}
+        save_cleaned_data_to_cache(cache_key, final_data, metadata, session_values['intake_ledger'])
+
+    return {'dataset_key': put_dataset(final_data), 'session': session_values, 'from_cache': False}
+
+# Write the values a finished job computed for the session into the session state
+def apply_session_values(session_values):
+    for key, value in session_values.items():
+        if key == 'kpi_accumulator':
+            store_kpis(value)
+        elif key == 'intake_ledger':
+            store_intake_ledger(value)
+        else:
+            st.session_state[key] = value
+
+# What the user should know about a cleaned dataset
+def show_cleaning_report(result):
+    session_values = result['session']
+    if result.get('from_cache'):
+        st.info('This file has been cleaned before, the cleaned data was loaded from the cache.')
+        return
+    if 'appended_rows' in result:
+        st.success(f"Appended {result['appended_rows']} cleaned records ({result['replaced_rows']} existing records replaced) "
+                   f"in {result['seconds']:.1f}s, the dataset now has {result['total_rows']} records.")
+    else:
+        with st.expander('Preprocessing stage timings'):
+            st.table(pd.DataFrame(session_values['preprocessing_timings']))
+            st.write(f"Cleaned data uses {session_values['cleaned_memory_per_row']:.0f} bytes per row in memory.")
+
+        # Let the user know what was removed because of missing data
+        missing_data_report = session_values.get('missing_data_report')
+        if missing_data_report is not None and (missing_data_report['dropped_columns'] or missing_data_report['dropped_rows']):
+            dropped_columns = ', '.join(missing_data_report['dropped_columns']) or 'none'
+            st.info(f"Missing data: dropped {missing_data_report['dropped_rows']} rows, dropped columns: {dropped_columns}.")
+
+    # Let the user know if some dates did not match the detected format
+    date_parsing_report = session_values.get('date_parsing_report', {})
+    for col, report in date_parsing_report.items():
+        if report['fallback_rows'] > 0:
+            st.warning(f"{report['fallback_rows']} rows in {col} did not match the detected date format ({report['format']}) and were parsed one by one.")
+
+# Start cleaning the upload, or appending it to the cleaned dataset of the session
+def start_cleaning_job(data, append=False):
+    # A new click replaces a cleaning job that is still running
+    if st.session_state.get('cleaning_job_id') is not None:
+        cancel_job(st.session_state['cleaning_job_id'])
+
+    if append:
+        append_base = get_append_base()
+        if append_base is None:
+            st.error('There is no cleaned dataset to append to, please clean a full dataset first.')
+            return None
+        job_id = submit_job('append', append_upload_job, data, append_base)
+    else:
+        job_id = submit_job('cleaning', clean_upload_job, data, st.session_state.get('uploaded_file_hash'))
+    st.session_state['cleaning_job_id'] = job_id
+    return job_id
+
+# Show the progress of the session's cleaning job. When it is done the cleaned data is handed to the session
+# and returned, while it runs the page is rerun every JOB_POLL_SECONDS to update the progress.
+def plot_cleaning_job():
+    job = poll_session_job('cleaning_job_id', 'Cleaning')
+    if job is None or job['status'] != 'done':
+        return None
+
+    result = pop_job_result(job['id'])
+    apply_session_values(result['session'])
+    # The session keeps a handle to the cleaned data, the data itself is shared in the dataset store
+    st.session_state['cleaned_data_key'] = result['dataset_key']
+    show_cleaning_report(result)
+    return get_cleaned_data()
+
+
+# On-disk cache of cleaned datasets, keyed by the hash of the uploaded bytes and the pipeline version.
+# Each entry is a Parquet file with the cleaned frame, one with its intake ledger and a JSON file with the reports.
+# Bump PIPELINE_VERSION whenever the cleaning output changes so older entries are not reused.
+PIPELINE_VERSION = '4'
+CLEANED_DATA_CACHE_DIR = os.environ.get('SHELTER_CACHE_DIR', os.path.join(ARTIFACT_DIR, '.shelter_cache', 'cleaned_data'))
+CLEANED_DATA_CACHE_MAX_BYTES = int(os.environ.get('SHELTER_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# The shelter metrics are not saved, they are counted again from the cached intake ledger
+CACHED_SESSION_STATE_KEYS = ['date_parsing_report', 'missing_data_report', 'preprocessing_timings', 'cleaned_memory_per_row']
+
+def cleaned_data_cache_key(upload_hash):
+    return hashlib.sha256(f'{upload_hash}:{PIPELINE_VERSION}'.encode()).hexdigest()
+
+def cleaned_data_cache_paths(cache_key):
+    return (os.path.join(CLEANED_DATA_CACHE_DIR, f'{cache_key}.parquet'),
+            os.path.join(CLEANED_DATA_CACHE_DIR, f'{cache_key}.json'),
+            os.path.join(CLEANED_DATA_CACHE_DIR, f'{cache_key}.ledger.parquet'))
+
+def load_cleaned_data_from_cache(cache_key):
+    data_path, metadata_path, ledger_path = cleaned_data_cache_paths(cache_key)
+    try:
+        data = pd.read_parquet(data_path)
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        intake_ledger = pd.read_parquet(ledger_path)
+    except (OSError, ValueError):
+        return None
+
+    # Touch the entry so eviction sees it as recently used
+    for path in (data_path, metadata_path, ledger_path):
+        os.utime(path)
+    return data, metadata, intake_ledger
+
+def save_cleaned_data_to_cache(cache_key, data, metadata, intake_ledger):
+    data_path, metadata_path, ledger_path = cleaned_data_cache_paths(cache_key)
+    try:
+        os.makedirs(CLEANED_DATA_CACHE_DIR, exist_ok=True)
+        # Write to temporary files first so other sessions never read a half-written entry
+        data.to_parquet(data_path + '.tmp', index=False)
+        intake_ledger.to_parquet(ledger_path + '.tmp', index=False)
+        with open(metadata_path + '.tmp', 'w') as f:
+            json.dump(metadata, f, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        os.replace(ledger_path + '.tmp', ledger_path)
+        os.replace(metadata_path + '.tmp', metadata_path)
+        os.replace(data_path + '.tmp', data_path)
+    except (OSError, ValueError, TypeError, AttributeError):
+        # The cache is only an optimisation, a dataset that cannot be cached is simply cleaned again next time
+        return False
+
+    evict_cleaned_data_cache()
+    return True
+
+# Remove the least recently used entries until the cache fits in max_bytes
+def evict_cleaned_data_cache(max_bytes=None):
+    evict_cache_dir(CLEANED_DATA_CACHE_DIR, CLEANED_DATA_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+# The files of an entry share the cache key before the first dot, an entry is last used when its newest file was
+def evict_cache_dir(cache_dir, max_bytes):
+    entries = {}
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(('.parquet', '.json')):
+            continue
+        cache_key = file_name.split('.', 1)[0]
+        stat = os.stat(os.path.join(cache_dir, file_name))
+        entry = entries.setdefault(cache_key, {'size': 0, 'last_used': 0, 'files': []})
+        entry['size'] += stat.st_size
+        entry['last_used'] = max(entry['last_used'], stat.st_mtime)
+        entry['files'].append(file_name)
+
+    total_size = sum(entry['size'] for entry in entries.values())
+    for cache_key, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+        if total_size <= max_bytes:
+            break
+        for file_name in entry['files']:
+            path = os.path.join(cache_dir, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+        total_size -= entry['size']
+
+
+# Process-level dataset store shared by all browser sessions. Frames are stored once, keyed by their content
+# fingerprint, and sessions keep only the key in their session state, so ten sessions on the same file share
+# one copy. Stored frames must not be modified in place.
+# When the frames in memory go over DATASET_STORE_MAX_BYTES, the least recently used ones are spilled to
+# Parquet files and read back the next time they are asked for. Other values (e.g. filter indexes) are
+# dropped instead and rebuilt by their caller.
+DATASET_STORE_MAX_BYTES = int(os.environ.get('SHELTER_DATASET_STORE_MAX_BYTES', 1024 ** 3))
+DATASET_STORE_SPILL_DIR = os.environ.get('SHELTER_DATASET_STORE_SPILL_DIR', os.path.join(ARTIFACT_DIR, '.shelter_cache', 'dataset_store'))
+DATASET_STORE_SPILL_MAX_BYTES = int(os.environ.get('SHELTER_DATASET_STORE_SPILL_MAX_BYTES', 4 * 1024 ** 3))
+
+_dataset_store = OrderedDict()
+_dataset_store_lock = threading.Lock()
+_dataset_store_stats = {'hits': 0, 'misses': 0, 'deduplicated': 0, 'spills': 0, 'reloads': 0, 'dropped': 0}
+
+def dataset_store_spill_path(dataset_key):
+    return os.path.join(DATASET_STORE_SPILL_DIR, f'{dataset_key}.parquet')
+
+# Memory used by a frame, or by the arrays in a dict of arrays
+def dataset_nbytes(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(dataset_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(dataset_nbytes(item) for item in value)
+    return 0
+
+# Store a value and return its key. A frame is keyed by its content, so storing a frame that is already
+# there keeps the stored copy: callers should carry on with get_dataset(key), not with their own copy.
+def put_dataset(value, dataset_key=None):
+    if dataset_key is None:
+        dataset_key = frame_fingerprint(value)
+
+    with _dataset_store_lock:
+        if dataset_key in _dataset_store:
+            _dataset_store.move_to_end(dataset_key)
+            _dataset_store_stats['deduplicated'] += 1
+            return dataset_key
+
+        _dataset_store[dataset_key] = {'value': value, 'nbytes': dataset_nbytes(value)}
+        evict_dataset_store()
+    return dataset_key
+
+def get_dataset(dataset_key):
+    if dataset_key is None:
+        return None
+
+    with _dataset_store_lock:
+        entry = _dataset_store.get(dataset_key)
+        if entry is not None:
+            _dataset_store.move_to_end(dataset_key)
+            _dataset_store_stats['hits'] += 1
+            return entry['value']
+
+    # A spilled frame is read back without holding the lock, so other sessions are not blocked by the read.
+    # Parquet keeps the categorical columns, so the frame comes back with the compact schema.
+    spill_path = dataset_store_spill_path(dataset_key)
+    try:
+        value = pd.read_parquet(spill_path)
+        os.utime(spill_path)
+    except FileNotFoundError:
+        with _dataset_store_lock:
+            _dataset_store_stats['misses'] += 1
+        return None
+
+    with _dataset_store_lock:
+        # Another session may have read it back in the meantime, everyone should share that copy
+        entry = _dataset_store.get(dataset_key)
+        if entry is not None:
+            _dataset_store.move_to_end(dataset_key)
+            _dataset_store_stats['hits'] += 1
+            return entry['value']
+
+        # Frames stored under their content fingerprint get it back without hashing, other keys (e.g. an
+        # upload hash or a prediction key) say nothing about the frame's content
+        if is_frame_fingerprint(dataset_key):
+            remember_frame_fingerprint(value, dataset_key)
+        _dataset_store[dataset_key] = {'value': value, 'nbytes': dataset_nbytes(value)}
+        _dataset_store_stats['reloads'] += 1
+        evict_dataset_store()
+        return value
+
+# Spill or drop the least recently used values until the store fits in its budget, keeping the newest value.
+# Called with the store lock held.
+def evict_dataset_store():
+    total_bytes = sum(entry['nbytes'] for entry in _dataset_store.values())
+    for dataset_key in list(_dataset_store)[:-1]:
+        if total_bytes <= DATASET_STORE_MAX_BYTES:
+            break
+        entry = _dataset_store.pop(dataset_key)
+        total_bytes -= entry['nbytes']
+
+        if not isinstance(entry['value'], pd.DataFrame):
+            _dataset_store_stats['dropped'] += 1
+            continue
+        spill_path = dataset_store_spill_path(dataset_key)
+        if not os.path.exists(spill_path):
+            try:
+                os.makedirs(DATASET_STORE_SPILL_DIR, exist_ok=True)
+                entry['value'].to_parquet(spill_path + '.tmp', index=True)
+                os.replace(spill_path + '.tmp', spill_path)
+                evict_cache_dir(DATASET_STORE_SPILL_DIR, DATASET_STORE_SPILL_MAX_BYTES)
+            except (OSError, ValueError, TypeError):
+                # A frame that cannot be spilled is dropped, the sessions using it have to load their data again
+                _dataset_store_stats['dropped'] += 1
+                continue
+        _dataset_store_stats['spills'] += 1
+
+# Memory and disk use of the store, for the sidebar
+def get_dataset_store_stats():
+    with _dataset_store_lock:
+        memory_bytes = sum(entry['nbytes'] for entry in _dataset_store.values())
+        stats = {
+            'values_in_memory': len(_dataset_store),
+            'memory_mb': round(memory_bytes / 1024 ** 2, 1),
+            'memory_budget_mb': round(DATASET_STORE_MAX_BYTES / 1024 ** 2, 1),
+        }
+        stats.update(_dataset_store_stats)
+
+    spill_files = os.listdir(DATASET_STORE_SPILL_DIR) if os.path.isdir(DATASET_STORE_SPILL_DIR) else []
+    stats['spilled_frames'] = sum(file_name.endswith('.parquet') for file_name in spill_files)
+    stats['spill_mb'] = round(sum(os.path.getsize(os.path.join(DATASET_STORE_SPILL_DIR, file_name)) for file_name in spill_files) / 1024 ** 2, 1)
+    return stats
+
+def plot_dataset_store_stats():
+    with st.sidebar.expander('Dataset Store'):
+        st.table(pd.DataFrame([get_dataset_store_stats()]).T.rename(columns={0: 'value'}).astype(str))
+
+# The cleaned dataset of this session, kept in the dataset store
+def get_cleaned_data():
+    return get_dataset(st.session_state.get('cleaned_data_key'))
+
+
+# Background jobs: cleaning and scoring run in a process-level thread pool instead of the script thread.
+# A job function takes the job as its first argument and calls report_job_progress as it goes, which also
+# stops it with JobCancelled once the job has been cancelled. Pages poll the job status on every rerun and
+# hand the result to the session when the job is done. Finished jobs are forgotten after JOB_RESULT_SECONDS.
+JOB_THREADS = int(os.environ.get('SHELTER_JOB_THREADS', 2))
+JOB_RESULT_SECONDS = 3600
+JOB_POLL_SECONDS = 0.5
+# Large uploads are cleaned in about this many partitions, so the progress moves in steps of about 5%.
+# Partitions are kept to at least JOB_PARTITION_MIN_ROWS rows, so small uploads are cleaned in fewer.
+JOB_PROGRESS_PARTITIONS = 20
+JOB_PARTITION_MIN_ROWS = 5_000
+JOB_SCORING_CHUNK_ROWS = 50_000
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# Rows per partition when a job cleans an upload of num_rows rows
+def job_partition_size(num_rows):
+    return min(PREPROCESSING_PARTITION_SIZE, max(JOB_PARTITION_MIN_ROWS, -(-num_rows // JOB_PROGRESS_PARTITIONS)))
+_job_executor = None
+
+class JobCancelled(Exception):
+    pass
+
+def get_job_executor():
+    global _job_executor
+
+    with _jobs_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_THREADS, thread_name_prefix='shelter-job')
+        return _job_executor
+
+def submit_job(kind, job_function, *args):
+    job = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'status': 'queued',
+        'progress': 0.0,
+        'message': 'Waiting to start',
+        'error': None,
+        'result': None,
+        'cancel_event': threading.Event(),
+        # The job's profiled calls are shown to the session that submitted it
+        'session_id': profiling.get_session_id(),
+        'submitted_at': time.time(),
+        'finished_at': None,
+    }
+    with _jobs_lock:
+        # Forget finished jobs nobody collected
+        for job_id in [job_id for job_id, old_job in _jobs.items() if old_job['finished_at'] is not None and time.time() - old_job['finished_at'] > JOB_RESULT_SECONDS]:
+            del _jobs[job_id]
+        _jobs[job['id']] = job
+
+    get_job_executor().submit(run_job, job, job_function, args)
+    return job['id']
+
+def run_job(job, job_function, args):
+    try:
+        if job['cancel_event'].is_set():
+            raise JobCancelled()
+        job['status'] = 'running'
+        job['message'] = 'Starting'
+        with profiling.job_session(job['session_id'], job['kind']):
+            job['result'] = job_function(job, *args)
+        job['progress'] = 1.0
+        job['status'] = 'done'
+    except JobCancelled:
+        job['message'] = 'Cancelled'
+        job['status'] = 'cancelled'
+    except Exception as e:
+        logging.getLogger(__name__).exception('%s job %s failed', job['kind'], job['id'])
+        job['error'] = str(e)
+        job['status'] = 'failed'
+    job['finished_at'] = time.time()
+
+# Called by job functions, job is None when a job function is called directly
+def report_job_progress(job, progress, message):
+    if job is None:
+        return
+    if job['cancel_event'].is_set():
+        raise JobCancelled()
+    job['progress'] = progress
+    job['message'] = message
+
+def job_cancel_event(job):
+    return None if job is None else job['cancel_event']
+
+def get_job_status(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: job[key] for key in ['id', 'kind', 'status', 'progress', 'message', 'error', 'submitted_at', 'finished_at']}
+
+def cancel_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        job['cancel_event'].set()
+
+def pop_job_result(job_id):
+    with _jobs_lock:
+        job = _jobs.pop(job_id, None)
+    return None if job is None else job['result']
+
+# Show the job the session has under session_key. A queued or running job gets a progress bar and a cancel
+# button, and the page is rerun after JOB_POLL_SECONDS. Returns the status of a finished job (its result is
+# left for the caller) and None when there is no job.
+def poll_session_job(session_key, label):
+    job_id = st.session_state.get(session_key)
+    job = get_job_status(job_id) if job_id is not None else None
+    if job is None:
+        st.session_state.pop(session_key, None)
+        return None
+
+    if job['status'] in ('queued', 'running'):
+        st.progress(job['progress'], text=f"{label}: {job['message']}")
+        if st.button(f'Cancel {label.lower()}', key=f'cancel_{session_key}'):
+            cancel_job(job_id)
+        time.sleep(JOB_POLL_SECONDS)
+        st.experimental_rerun()
+
+    st.session_state.pop(session_key, None)
+    if job['status'] == 'failed':
+        pop_job_result(job_id)
+        st.error(f"{label} failed: {job['error']}")
+    elif job['status'] == 'cancelled':
+        pop_job_result(job_id)
+        st.warning(f'{label} was cancelled.')
+    return job
+
+
+# Append a new export (e.g. last night's intakes and outcomes) to the cleaned dataset of a session.
+# Only the new rows are cleaned. A new record with the same animal_id and intake date as an existing record
+# replaces it, and the merged records are put in the order initial_preprocessing sorts them in.
+# The KPI accumulator and the dashboard metrics cube are updated with the difference instead of recomputed.
+# get_append_base takes what the job needs from the session, so the job itself runs without it.
+def get_append_base():
+    existing_data_key = st.session_state.get('cleaned_data_key')
+    intake_ledger_key = st.session_state.get('intake_ledger_key')
+    if get_dataset(existing_data_key) is None or get_intake_ledger() is None:
+        return None
+
+    return {
+        'dataset_key': existing_data_key,
+        'intake_ledger_key': intake_ledger_key,
+        'kpi_accumulator': st.session_state.get('kpi_accumulator'),
+        # Columns dropped for missing data in the full dataset stay dropped
+        'dropped_columns': (st.session_state.get('missing_data_report') or {}).get('dropped_columns', []),
+    }
+
+def append_upload_job(job, new_data, append_base):
+    existing_data = get_dataset(append_base['dataset_key'])
+    intake_ledger = get_dataset(append_base['intake_ledger_key'])
+    if existing_data is None or intake_ledger is None:
+        raise ValueError('The cleaned dataset to append to is no longer available, please clean it again.')
+    kept_columns = [col for col in new_data.columns if col not in append_base['dropped_columns']]
+
+    def show_partition_progress(partitions_done, num_partitions):
+        report_job_progress(job, 0.8 * partitions_done / num_partitions, f'Preprocessing new records: {partitions_done}/{num_partitions} partitions cleaned')
+
+    start_time = time.perf_counter()
+    new_cleaned_data, _, new_values = partitioned_preprocessing(new_data, kept_columns=kept_columns, on_partition_complete=show_partition_progress,
+                                                                partition_size=job_partition_size(len(new_data)), cancel_event=job_cancel_event(job))
+    new_ledger = new_values['intake_ledger']
+    report_job_progress(job, 0.85, 'Merging the new records into the dataset')
+
+    # Existing records that the new export replaces
+    new_keys = pd.MultiIndex.from_frame(new_ledger[LEDGER_KEY_COLUMNS])
+    replaced_ledger = pd.MultiIndex.from_frame(intake_ledger[LEDGER_KEY_COLUMNS]).isin(new_keys)
+    replaced_rows = pd.MultiIndex.from_frame(existing_data[LEDGER_KEY_COLUMNS]).isin(new_keys)
+
+    # Merge the cleaned records, keeping the sort order of initial_preprocessing
+    merged_data = pd.concat([existing_data[~replaced_rows], new_cleaned_data], ignore_index=True)
+    merged_data = merged_data.sort_values(by=SORT_COLUMNS, ascending=SORT_ASCENDING).reset_index(drop=True)
+    merged_data = compact_shelter_frame(merged_data)
+
+    # Shelter metrics: take away what the replaced records counted towards and add the new records
+    kpi_accumulator = append_base['kpi_accumulator']
+    if kpi_accumulator is None:
+        kpi_accumulator = build_kpi_accumulator(intake_ledger)
+    session_values = {
+        'kpi_accumulator': merge_kpi_accumulators([kpi_accumulator, -build_kpi_accumulator(intake_ledger[replaced_ledger]), new_values['kpi_accumulator']]),
+        'intake_ledger': pd.concat([intake_ledger[~replaced_ledger], new_ledger], ignore_index=True),
+        'date_parsing_report': new_values['date_parsing_report'],
+        'cleaned_memory_per_row': memory_per_row(merged_data),
+    }
+
+    # Dashboard metrics cube: take away the replaced records and add the new ones
+    cube = get_dataset(metrics_cube_key(frame_fingerprint(existing_data)))
+    if cube is not None:
+        put_dataset(update_metrics_cube(cube, existing_data[replaced_rows], new_cleaned_data), metrics_cube_key(frame_fingerprint(merged_data)))
+
+    return {
+        'dataset_key': put_dataset(merged_data),
+        'session': session_values,
+        'appended_rows': len(new_cleaned_data),
+        'replaced_rows': int(replaced_rows.sum()),
+        'total_rows': len(merged_data),
+        'seconds': time.perf_counter() - start_time,
+    }
+
+# Stages of the cleaning pipeline, in the order they are run
+def get_preprocessing_stages():
+    return [
+        ('Initial preprocessing', initial_preprocessing),
+        ('Data transformation', data_transformation),
+        ('Feature derivation', transform_data),
+    ]
 
-        for percent_complete in range(1, 101):
-            progress_bar.progress(percent_complete)
-            status_text.text(f"Preprocessing data: {percent_complete}% Complete")
-            # Add a short sleep to simulate processing time
-            time.sleep(0.1)
-    
-        # After preprocessing is complete, update the progress bar and status text
-        progress_bar.empty()
+# Wall-clock time since start_time and rows in/out of one pipeline stage
+def stage_timing(stage_name, start_time, rows_in, rows_out):
+    return {
+        'stage': stage_name,
+        'seconds': round(time.perf_counter() - start_time, 3),
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+    }
+
+# Add up the timings of the same stages over all partitions, keeping the order of the stages
+def sum_stage_timings(partition_timings):
+    totals = {}
+    for timings in partition_timings:
+        for timing in timings:
+            total = totals.setdefault(timing['stage'], {'stage': timing['stage'], 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0})
+            total['seconds'] += timing['seconds']
+            total['rows_in'] += timing['rows_in']
+            total['rows_out'] += timing['rows_out']
+    return [dict(total, seconds=round(total['seconds'], 3)) for total in totals.values()]
+
+# Run the cleaning pipeline stage by stage, recording wall-clock time and rows in/out for each stage.
+# on_stage_complete(stage_num, num_stages, stage_name) is called after every stage to report progress.
+def run_preprocessing_stages(data, on_stage_complete=None):
+    stages = get_preprocessing_stages()
+    stage_timings = []
+
+    for stage_num, (stage_name, stage_function) in enumerate(stages, start=1):
+        rows_in = len(data)
+        start_time = time.perf_counter()
+        data = stage_function(data)
+        stage_timings.append(stage_timing(stage_name, start_time, rows_in, len(data)))
+
+        if on_stage_complete is not None:
+            on_stage_complete(stage_num, len(stages), stage_name)
+
+    return data, stage_timings
+
+
+# Parallel preprocessing settings, set SHELTER_PREPROCESSING_WORKERS above 1 to clean uploads with a process pool
+PREPROCESSING_WORKERS = int(os.environ.get('SHELTER_PREPROCESSING_WORKERS', 1))
+PREPROCESSING_PARTITION_SIZE = int(os.environ.get('SHELTER_PREPROCESSING_PARTITION_SIZE', 250_000))
+
+# The worker processes are started once and reused, starting them is slower than cleaning a small upload
+_preprocessing_executors = {}
+_preprocessing_executors_lock = threading.Lock()
+
+def get_preprocessing_executor(workers):
+    with _preprocessing_executors_lock:
+        if workers not in _preprocessing_executors:
+            _preprocessing_executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                                    initializer=init_preprocessing_worker)
+        return _preprocessing_executors[workers]
+
+def init_preprocessing_worker():
+    # Worker processes run outside `streamlit run`, so silence the session state and pandas copy warnings
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
+
+# Split the data into partitions by a hash of animal_id, so all records of an animal land in the same partition
+def partition_by_animal_id(data, num_partitions):
+    partition_ids = pd.util.hash_pandas_object(data['animal_id'], index=False).to_numpy() % num_partitions
+    return [partition for _, partition in data.groupby(partition_ids, sort=True)]
+
+# Per-row part of the pipeline for one partition, run in a worker process.
+# The column-level decisions (which columns to keep) are made on the whole dataset beforehand.
+# The stages are timed like in run_preprocessing_stages, so the timings can be added up over the partitions.
+def preprocess_partition(partition, kept_columns):
+    stage_names = [stage_name for stage_name, _ in get_preprocessing_stages()]
+    stage_timings = []
+
+    start_time = time.perf_counter()
+    rows_in = len(partition)
+    date_parsing_report = {}
+    for col in ['intake_date_time', 'outcome_date_time']:
+        partition[col], date_parsing_report[col] = parse_date_column(partition[col])
+    intake_ledger = build_intake_ledger(partition)
+
+    # Drop rows with missing data in the kept columns, including dates that could not be parsed
+    partition = partition.loc[~partition[kept_columns].isnull().any(axis=1), kept_columns + ['_row_position']]
+    partition = filter_valid_records(partition)
+
+    # The shelter metrics are counted after the initial preprocessing, as in initial_preprocessing
+    record_ledger_outcomes(intake_ledger, partition)
+    kpi_accumulator = build_kpi_accumulator(intake_ledger)
+    stage_timings.append(stage_timing(stage_names[0], start_time, rows_in, len(partition)))
+
+    # Nothing left to transform, e.g. a small partition without cat or dog records. Its intakes are
+    # still counted, and the merge leaves the empty partition out.
+    if partition.empty:
+        return partition, kpi_accumulator, date_parsing_report, intake_ledger, stage_timings
+
+    for stage_name, stage_function in zip(stage_names[1:], [data_transformation, transform_data]):
+        start_time = time.perf_counter()
+        rows_in = len(partition)
+        partition = stage_function(partition)
+        stage_timings.append(stage_timing(stage_name, start_time, rows_in, len(partition)))
+    return partition, kpi_accumulator, date_parsing_report, intake_ledger, stage_timings
+
+# Multi-core version of run_preprocessing_stages with the same output, row order and shelter metrics.
+# Missing-data column drops are decided from the raw values, so a date column only pushed over the
+# 30% threshold by unparseable dates is kept (its unparseable rows are still dropped).
+def run_parallel_preprocessing(data, workers=None, partition_size=None, on_stage_complete=None):
+    final_data, stage_timings, session_values = partitioned_preprocessing(data, workers, partition_size, on_stage_complete)
+    apply_session_values(session_values)
+    return final_data, stage_timings
+
+# The partitioned pipeline without the session state: returns the cleaned data, the stage timings and the
+# values for the session. on_partition_complete(partitions_done, num_partitions) is called as partitions
+# finish, and setting cancel_event stops the run (with JobCancelled) between partitions.
+# The columns to keep can be given, e.g. the columns kept for the dataset an export is appended to.
+def partitioned_preprocessing(data, workers=None, partition_size=None, on_stage_complete=None, on_partition_complete=None,
+                              cancel_event=None, kept_columns=None):
+    workers = workers or PREPROCESSING_WORKERS
+    partition_size = partition_size or PREPROCESSING_PARTITION_SIZE
+    stage_timings = []
+    num_stages = 3
+
+    def record_stage(stage_name, start_time, rows_in, rows_out):
+        stage_timings.append(stage_timing(stage_name, start_time, rows_in, rows_out))
+        if on_stage_complete is not None:
+            on_stage_complete(len(stage_timings), num_stages, stage_name)
+
+    def partition_complete(partitions_done, num_partitions):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled()
+        if on_partition_complete is not None:
+            on_partition_complete(partitions_done, num_partitions)
+
+    # Stage 1: whole-dataset decisions, then partition
+    start_time = time.perf_counter()
+    rows_in = len(data)
+    kept_columns, _, missing_data_report = plan_missing_data(data) if kept_columns is None else (pd.Index(kept_columns), None, None)
+    kept_columns = kept_columns.tolist()
+
+    data = data.reset_index(drop=True)
+    data['_row_position'] = np.arange(len(data))
+    # One partition per worker at least, but never more partitions than rows
+    num_partitions = max(1, min(max(workers, -(-len(data) // partition_size)), len(data)))
+    # An empty upload is still run as one (empty) partition, so its reports and columns are the usual ones
+    partitions = partition_by_animal_id(data, num_partitions) or [data]
+    record_stage(f'Partitioning ({len(partitions)} partitions)', start_time, rows_in, rows_in)
+
+    # Stage 2: per-row preprocessing in the process pool
+    start_time = time.perf_counter()
+    results = [None] * len(partitions)
+    if workers > 1 and len(partitions) > 1:
+        executor = get_preprocessing_executor(workers)
+        futures = {executor.submit(preprocess_partition, partition, kept_columns): partition_num for partition_num, partition in enumerate(partitions)}
+        try:
+            for partitions_done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                partition_complete(partitions_done, len(partitions))
+        except JobCancelled:
+            for future in futures:
+                future.cancel()
+            raise
+    else:
+        for partition_num, partition in enumerate(partitions):
+            results[partition_num] = preprocess_partition(partition, kept_columns)
+            partition_complete(partition_num + 1, len(partitions))
+    record_stage(f'Parallel preprocessing ({workers} workers)', start_time, rows_in, sum(len(result[0]) for result in results))
+
+    # Stage 3: merge the partitions back in the order the serial pipeline produces
+    start_time = time.perf_counter()
+    cleaned_partitions = [result[0] for result in results if not result[0].empty]
+    if cleaned_partitions:
+        final_data = pd.concat(cleaned_partitions, ignore_index=True)
+    else:
+        # No records left at all, transform an empty partition to get the columns of the cleaned data
+        final_data = transform_data(data_transformation(results[0][0]))
+    final_data = final_data.sort_values('_row_position').sort_values(by=SORT_COLUMNS, ascending=SORT_ASCENDING)
+    final_data = final_data.drop(columns='_row_position').reset_index(drop=True)
+    # Categories differ between partitions, so the merged columns are converted back to the compact schema
+    final_data = compact_shelter_frame(final_data)
+    record_stage('Merge', start_time, len(final_data), len(final_data))
+    # The pipeline stages inside the partitions, with their time added up over all partitions, are shown
+    # under the parallel preprocessing stage
+    stage_timings[2:2] = [dict(timing, stage=f"{timing['stage']} (all partitions)") for timing in sum_stage_timings(result[4] for result in results)]
+
+    # Combine the per-partition reports and metrics
+    date_parsing_report = {}
+    for col in ['intake_date_time', 'outcome_date_time']:
+        date_formats = sorted({result[2][col]['format'] for result in results if result[2][col]['format'] is not None})
+        date_parsing_report[col] = {
+            'format': ', '.join(date_formats) or None,
+            'fallback_rows': sum(result[2][col]['fallback_rows'] for result in results),
+        }
+
+    session_values = {
+        'date_parsing_report': date_parsing_report,
+        'intake_ledger': pd.concat([result[3] for result in results], ignore_index=True),
+        'kpi_accumulator': merge_kpi_accumulators([result[1] for result in results]),
+    }
+    if missing_data_report is not None:
+        session_values['missing_data_report'] = missing_data_report
+    return final_data, stage_timings, session_values
+
+
+# Date layouts seen in shelter exports, tried in this order when inferring the format of a column.
+# Day-first layouts come before month-first ones to match the dayfirst=True parsing used elsewhere.
+SHELTER_DATE_FORMATS = [
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y',
+    '%d-%m-%Y %H:%M',
+    '%d-%m-%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y',
+]
+
+def infer_date_format(values, sample_size=1000):
+    # Take an evenly spaced sample of the non-null values so the whole file is represented
+    sample = values.dropna().astype(str).str.strip()
+    if len(sample) == 0:
+        return None
+    step = max(len(sample) // sample_size, 1)
+    sample = sample.iloc[::step].head(sample_size)
+
+    # Pick the known layout that parses the largest share of the sample
+    best_format, best_count = None, 0
+    for date_format in SHELTER_DATE_FORMATS:
+        parsed_count = pd.to_datetime(sample, format=date_format, errors='coerce').notna().sum()
+        if parsed_count > best_count:
+            best_format, best_count = date_format, parsed_count
+        if best_count == len(sample):
+            break
+
+    return best_format
+
+def parse_date_column(values, sample_size=1000):
+    # Already parsed (e.g. read from a typed source), nothing to do
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values, {'format': None, 'fallback_rows': 0}
+
+    date_format = infer_date_format(values, sample_size)
+
+    # Parse the whole column in one vectorized pass with the inferred layout
+    if date_format is not None:
+        parsed = pd.to_datetime(values.astype(str).str.strip(), format=date_format, errors='coerce')
+    else:
+        parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    parsed[values.isnull()] = pd.NaT
+
+    # Only the rows that did not match the inferred layout go through the row-wise parser
+    failed = values.notnull() & parsed.isnull()
+    fallback_rows = int(failed.sum())
+    if fallback_rows > 0:
+        parsed[failed] = pd.to_datetime(values[failed].apply(parse_date_value))
 
-        return final_data
+    return parsed, {'format': date_format, 'fallback_rows': fallback_rows}
 
+def parse_date_value(value):
+    # Row-wise fallback for values that do not match the inferred layout, unparseable values become NaT
+    try:
+        return parser.parse(str(value), dayfirst=True).strftime('%Y-%m-%d %H:%M:%S')
+    except (ValueError, OverflowError):
+        return pd.NaT
 
 def change_date_data_type(data):
     # change data type
-    data['intake_date_time'] = pd.to_datetime(data['intake_date_time'].apply(lambda x: parser.parse(x, dayfirst=True).strftime('%Y-%m-%d %H:%M:%S') if pd.notnull(x) else x))
-    data['outcome_date_time'] = pd.to_datetime(data['outcome_date_time'].apply(lambda x: parser.parse(x, dayfirst=True).strftime('%Y-%m-%d %H:%M:%S') if pd.notnull(x) else x))
+    date_parsing_report = {}
+    for col in ['intake_date_time', 'outcome_date_time']:
+        data[col], date_parsing_report[col] = parse_date_column(data[col])
+
+    st.session_state['date_parsing_report'] = date_parsing_report
 
-    # calculate number of intakes for each animal_id
-    total_num_intakes = data['intake_type'].count()
-    
-    st.session_state['total_num_intakes'] = total_num_intakes
-   
     return data
 
+# Work out in one pass which columns and rows remove_missing_data should drop.
+# Columns with more than the threshold share of missing values are dropped, then any row
+# that still has a missing value in the remaining columns is dropped.
+def plan_missing_data(data, threshold=0.3):
+    null_counts = data.isnull().sum()
+    columns_to_drop = null_counts[null_counts > threshold * len(data)].index.tolist()
+
+    kept_columns = data.columns.difference(columns_to_drop, sort=False)
+    rows_to_drop = data[kept_columns].isnull().any(axis=1)
+
+    report = {
+        'dropped_columns': columns_to_drop,
+        'dropped_rows': int(rows_to_drop.sum()),
+        'null_counts': {col: int(count) for col, count in null_counts.items() if count > 0},
+    }
+    return kept_columns, rows_to_drop, report
+
 def remove_missing_data(data):
 
-    # Check for missing data, if more than 30% then drop the column, if less than 30% then impute with mode or median
-    for col in data.columns:
-        if data[col].isnull().sum() > 0.3 * len(data):
-            data.drop(col, axis=1, inplace=True)
-        else:
-            # drop the rows with missing data
-            data.dropna(axis=0, inplace=True)
+    # Check for missing data, if more than 30% then drop the column, if less than 30% then drop the rows with missing data
+    kept_columns, rows_to_drop, report = plan_missing_data(data)
+    data = data.loc[~rows_to_drop, kept_columns]
+
+    st.session_state['missing_data_report'] = report
 
     return data
 
-def calculate_cat_dog_metric(data):
-    if st.session_state.get('total_num_intakes') is not None:
-        total_num_intakes = st.session_state.get('total_num_intakes')
-
-        # num_adoptions is when outcome_type is adoption
-        total_num_adoptions = data[data['outcome_type'] == 'Adoption']['outcome_type'].count()
-        # save_rate is Intake minus Euthanasia Outcomes divided by num Intake
-        num_euthanasia = data[data['outcome_type'] == 'Euthanasia']['outcome_type'].count()
-        save_rate = (total_num_intakes - num_euthanasia) / total_num_intakes
-        # st.write('num euthanasia', num_euthanasia)
-        # live_release_rate is the number of live outcomes divided by the number of intakes
-        num_death_in_shelter = data[data['outcome_type'] == 'Died']['outcome_type'].count()
-        # st.write('num deaths', num_death_in_shelter)
-        live_release_rate = (total_num_intakes - num_death_in_shelter) / total_num_intakes
-
-        st.session_state['total_num_adoptions'] = total_num_adoptions
-        st.session_state['save_rate'] = save_rate
-        # st.write('save rate', save_rate)
-        st.session_state['live_release_rate'] = live_release_rate
-        # st.write('live release rate', live_release_rate)
+def cat_dog_metrics(total_num_intakes, outcome_counts):
+    # num_adoptions is when outcome_type is adoption
+    total_num_adoptions = outcome_counts['Adoption']
+    # save_rate is Intake minus Euthanasia Outcomes divided by num Intake, there is no rate without intakes
+    num_euthanasia = outcome_counts['Euthanasia']
+    save_rate = (total_num_intakes - num_euthanasia) / total_num_intakes if total_num_intakes else np.nan
+    # live_release_rate is the number of live outcomes divided by the number of intakes
+    num_death_in_shelter = outcome_counts['Died']
+    live_release_rate = (total_num_intakes - num_death_in_shelter) / total_num_intakes if total_num_intakes else np.nan
+
+    return {
+        'total_num_adoptions': total_num_adoptions,
+        'save_rate': save_rate,
+        'live_release_rate': live_release_rate,
+    }
+
+# KPI engine: the shelter metrics are kept as accumulators, a frame of intake, adoption, euthanasia and death
+# counts per animal type and month. Outcomes are counted in the month of the intake they end, so the rates of a
+# month are those of the animals taken in that month. Accumulators of different parts of a dataset add up to the accumulator of the whole dataset,
+# so partitions and appended files are combined without going back to the records. The four cards, the
+# breakdowns per month, year and animal type and the trend deltas are all computed from the accumulator.
+KPI_OUTCOME_COLUMNS = {'Adoption': 'adoptions', 'Euthanasia': 'euthanasia', 'Died': 'deaths'}
+KPI_COUNT_COLUMNS = ['intakes', 'adoptions', 'euthanasia', 'deaths']
+KPI_GROUP_COLUMNS = ['animal_type', 'period']
+# Only cat and dog records are kept by the preprocessing, so only their outcomes are counted
+KPI_ANIMAL_TYPES = ['cat', 'dog']
+
+# Count every intake and outcome of an intake ledger in one grouped pass
+def build_kpi_accumulator(intake_ledger):
+    intakes = intake_ledger['counts_as_intake']
+    outcomes = intake_ledger['outcome_type'].map(KPI_OUTCOME_COLUMNS)
+    counted_outcomes = outcomes.notnull()
+
+    events = pd.DataFrame({
+        'animal_type': pd.concat([intake_ledger.loc[intakes, 'animal_type'], intake_ledger.loc[counted_outcomes, 'animal_type']]).astype(object),
+        'period': pd.concat([intake_ledger.loc[intakes, 'intake_date_time'], intake_ledger.loc[counted_outcomes, 'intake_date_time']]).dt.to_period('M'),
+        'measure': ['intakes'] * int(intakes.sum()) + outcomes[counted_outcomes].tolist(),
+    })
+    accumulator = events.groupby(KPI_GROUP_COLUMNS + ['measure'], dropna=False).size().unstack('measure', fill_value=0)
+    return accumulator.reindex(columns=KPI_COUNT_COLUMNS, fill_value=0).rename_axis(columns=None).astype('int64')
+
+# Add accumulators up. An accumulator multiplied by -1 takes its records away again.
+def merge_kpi_accumulators(accumulators):
+    accumulator = pd.concat(accumulators).groupby(level=KPI_GROUP_COLUMNS, dropna=False).sum()
+    return accumulator[(accumulator != 0).any(axis=1)]
+
+# Save rate and live release rate of each row of counts
+def add_kpi_rates(counts):
+    counts = counts.copy()
+    intakes = counts['intakes'].where(counts['intakes'] > 0)
+    counts['save_rate'] = (counts['intakes'] - counts['euthanasia']) / intakes
+    counts['live_release_rate'] = (counts['intakes'] - counts['deaths']) / intakes
+    return counts
+
+# The four card metrics
+def kpi_totals(accumulator):
+    totals = accumulator[KPI_COUNT_COLUMNS].sum()
+    outcome_counts = {outcome: int(totals[col]) for outcome, col in KPI_OUTCOME_COLUMNS.items()}
+    kpis = {'total_num_intakes': int(totals['intakes'])}
+    kpis.update(cat_dog_metrics(kpis['total_num_intakes'], outcome_counts))
+    return kpis
+
+# Counts and rates by 'month', 'year' or 'animal_type' (cats and dogs)
+def kpi_breakdown(accumulator, by):
+    counts = accumulator.reset_index()
+    if by == 'month':
+        keys = counts['period']
+    elif by == 'year':
+        keys = counts['period'].dt.year.rename('year')
+    else:
+        # Other animal types have intakes but no counted outcomes, so they are left out. Exports spell the
+        # animal types in different cases, which are counted together.
+        animal_types = counts['animal_type'].astype(str).str.lower()
+        counts = counts[animal_types.isin(KPI_ANIMAL_TYPES)]
+        keys = animal_types[counts.index].str.capitalize().rename('animal_type')
+    counts = counts[KPI_COUNT_COLUMNS].groupby(keys, dropna=True).sum()
+    return add_kpi_rates(counts).reset_index()
+
+# Change of the card metrics between the last two complete months with intakes. An export usually stops in the
+# middle of a month, so the latest month in the data is taken as partial and left out of the comparison.
+def kpi_trend(accumulator):
+    if accumulator is None:
+        return None
+    months = kpi_breakdown(accumulator, 'month')
+    months = months[months['intakes'] > 0]
+    if len(months) < 3:
+        return None
+
+    previous, latest = months.iloc[-3], months.iloc[-2]
+    return {
+        'period': str(latest['period']),
+        'previous_period': str(previous['period']),
+        'partial_period': str(months.iloc[-1]['period']),
+        'total_num_intakes': int(latest['intakes'] - previous['intakes']),
+        'total_num_adoptions': int(latest['adoptions'] - previous['adoptions']),
+        'save_rate': latest['save_rate'] - previous['save_rate'],
+        'live_release_rate': latest['live_release_rate'] - previous['live_release_rate'],
+    }
+
+def store_kpis(accumulator):
+    st.session_state['kpi_accumulator'] = accumulator
+    for key, value in kpi_totals(accumulator).items():
+        st.session_state[key] = value
+
+# Records are ordered by animal, latest intake and outcome first
+SORT_COLUMNS = ['animal_id', 'intake_date_time', 'outcome_date_time']
+SORT_ASCENDING = [True, False, False]
 
 # Part 1: Initial data preprocessing: missing data, data type, duplicates, filter, sort.
 def initial_preprocessing(data):
@@ -119,7 +1100,10 @@ def initial_preprocessing(data):
 
         data = change_date_data_type(data)
 
-        data = data.sort_values(by=['animal_id', 'intake_date_time', 'outcome_date_time'], ascending=[True, False, False])
+        # Record what every raw record counts towards, so appended files can update the metrics
+        intake_ledger = build_intake_ledger(data)
+
+        data = data.sort_values(by=SORT_COLUMNS, ascending=SORT_ASCENDING)
         
         # data = data.groupby('animal_id').head(1)
         
@@ -130,20 +1114,54 @@ def initial_preprocessing(data):
 
         data = remove_missing_data(data)
 
-        data = data.drop(data[data['outcome_date_time'] < data['intake_date_time']].index, axis=0)
+        data = filter_valid_records(data)
 
-        # Filter the data to only have animal_type dog and cat
-        data = data[data['animal_type'].str.lower().isin(['dog', 'cat'])]
+        # The ledger only feeds the metrics here. Cleaning jobs keep their ledger in the dataset store for
+        # appending, this serial path (e.g. batch scoring, one chunk at a time) must not fill the store.
+        record_ledger_outcomes(intake_ledger, data)
 
         # Reset the index
         data = data.reset_index(drop=True)
 
         # calculate the metrics: num_adoptions, save_rate, live_release_rate for cats and dogs only
-        calculate_cat_dog_metric(data)
+        store_kpis(build_kpi_accumulator(intake_ledger))
 
 
     return data
 
+def filter_valid_records(data):
+    data = data.drop(data[data['outcome_date_time'] < data['intake_date_time']].index, axis=0)
+
+    # Filter the data to only have animal_type dog and cat
+    data = data[data['animal_type'].str.lower().isin(KPI_ANIMAL_TYPES)]
+    return data
+
+# Intake ledger: one row per raw record with its key and what it counts towards in the shelter metrics.
+# Every record with an intake type counts as an intake, and the outcome of a record that is still there
+# after the initial preprocessing counts towards the adoption, euthanasia and death numbers.
+# The animal type and intake date are kept so the KPI engine can break the metrics down.
+LEDGER_KEY_COLUMNS = ['animal_id', 'intake_date_time']
+
+def build_intake_ledger(data):
+    return pd.DataFrame({
+        'animal_id': data['animal_id'],
+        'intake_date_time': data['intake_date_time'],
+        'animal_type': data['animal_type'].astype('category'),
+        'counts_as_intake': data['intake_type'].notnull(),
+        'outcome_type': pd.Series(np.nan, index=data.index, dtype=object),
+    })
+
+# The preprocessed records keep the index of the raw records, which is the index of the ledger
+def record_ledger_outcomes(intake_ledger, data):
+    intake_ledger.loc[data.index, 'outcome_type'] = data['outcome_type'].astype(object)
+
+# The ledger is kept in the dataset store next to its dataset, the session only keeps its key
+def store_intake_ledger(intake_ledger):
+    st.session_state['intake_ledger_key'] = put_dataset(intake_ledger)
+
+def get_intake_ledger():
+    return get_dataset(st.session_state.get('intake_ledger_key'))
+
 # Part 2: Create a function to transform the data
 def data_transformation(data):
     # data = data.reset_index(drop=True)
@@ -151,405 +1169,551 @@ def data_transformation(data):
     data['days_in_shelter'] = (data['outcome_date_time'] - data['intake_date_time']).dt.days
     # Filter days_in_shelter maximum is 365 days
     data = data[data['days_in_shelter'] <= 365]
+    data['days_in_shelter'] = data['days_in_shelter'].astype('int16')
 
     # Create intake and outcome month and year
-    data['outcome_month'] = data['outcome_date_time'].dt.month
-    data['outcome_year'] = data['outcome_date_time'].dt.year
+    data['outcome_month'] = data['outcome_date_time'].dt.month.astype('int8')
+    data['outcome_year'] = data['outcome_date_time'].dt.year.astype('int16')
 
-    # Create age_group
-    # Check if age is numeric or categorical
-    if data['age'].str.contains(r'year|month|day', case=False).any():
-        # remove special characters and leading or trailing spaces
-        data['age'] = data['age'].apply(lambda x: re.sub(r'[^a-zA-Z0-9 ]', '', str(x)))
-        data['age'] = data['age'].str.strip()
-
-        age_days = data['age'].apply(lambda x: int(x.split()[0])*365 
-                                                       if 'year' in x else (int(x.split()[0])*30 
-                                                                            if 'month' in x else int(x.split()[0])))
-        age_years = age_days//365
-        data['age'] = age_years 
-        data['age_group'] = age_years.apply(age_group)
-        # tranform_column(data)
+    # Convert age to years, rows whose age cannot be read are dropped
+    data['age'] = parse_age_years(data['age'])
+    data = data[data['age'].notna()]
+    data['age'] = downcast_age(data['age'])
 
-    else:
-        # calculate the age days if the age is numeric # assuming the original value is in days
-        # age_days = data['age'].apply(lambda x: int(x)*365)
-        # age_years = age_days//365
-        # data['age'] = age_years
-        data['age_group'] = data['age'].apply(age_group)
-        # tranform_column(data)
+    # Create age_group
+    data['age_group'] = make_age_group(data['age'])
     # st.write(data.head(3))
     return data
 
 def transform_data(data):
 
-    data[['new_gender', 'intact_status']] = data['gender'].apply(separate_gender_and_intact_status).apply(pd.Series)
+    # Derive the features on the unique values of each column only, then broadcast them back to the rows
+    gender_features = derive_from_unique_values(data['gender'], derive_gender_and_intact_status)
+    data['new_gender'] = gender_features['gender']
+    data['intact_status'] = gender_features['intact_status']
 
-    data[['new_breed', 'is_mix_breed']] = data['breed'].apply(separate_breed).apply(pd.Series)
+    breed_features = derive_from_unique_values(data['breed'], derive_breed)
+    data['new_breed'] = breed_features['breed']
+    data['is_mix_breed'] = breed_features['is_mix_breed']
+
+    colour_features = derive_from_unique_values(data['colour'], derive_colour)
+    for col in ['new_colour', 'is_multicolour', 'is_black', 'is_white', 'is_brown', 'is_yellow', 'is_gray']:
+        data[col] = colour_features[col.replace('new_', '')]
 
-    # st.write('new_breed', len(data['new_breed']))
-    data[['new_colour', 'is_multicolour']] = data['colour'].apply(separate_colour).apply(pd.Series)
-    data['is_multicolour'] = data.apply(update_multicolour, axis=1)
-    data[['is_black', 'is_white', 'is_brown', 'is_yellow', 'is_gray']] = data['colour'].apply(lambda x: separate_colour_columns(x)).apply(pd.Series)
-        
     data.drop(['gender','breed', 'colour'], axis=1, inplace=True)
 
     data['outcome_type'] = data.pop('outcome_type')
-    data['intake_type'] = data['intake_type'].str.lower()
-    data['animal_type'] = data['animal_type'].str.lower()
-    data['outcome_type'] = data['outcome_type'].str.lower()
-    data['intake_condition'] = data['intake_condition'].str.lower()
+    data['intake_type'] = to_lower_categorical(data['intake_type'])
+    data['animal_type'] = to_lower_categorical(data['animal_type'])
+    data['outcome_type'] = to_lower_categorical(data['outcome_type'])
+    data['intake_condition'] = to_lower_categorical(data['intake_condition'])
     final_data = data.reset_index(drop=True)
     # rename the columns
     final_data.rename(columns={'new_breed': 'breed', 'new_colour': 'colour', 'new_gender': 'gender'}, inplace=True)
 
-    return final_data
-
-def separate_gender_and_intact_status(value):
-    value = value.lower()
-    gender = 'unknown'  # Initialize the gender variable with a default value
-
-    if 'neutered' in value:
-        value = value.split(' ')[0]
-        gender = 'male'
-        intact_status = 'neutered'
-    elif 'spayed' in value:
-        value = value.split(' ')[0]
-        gender = 'female'
-        intact_status = 'spayed'
-    elif 'intact' in value:
-        value = value.split(' ')[1]
-        intact_status = 'intact'
-        if value == 'male':
-            gender = 'male'
-        elif value == 'female':
-            gender = 'female'
-        else:
-            intact_status = 'unknown'
-    else:
-        intact_status = 'unknown'
-
-    return gender, intact_status
-
-def age_group(age):
-    if age <= 1:
-        return 'puppy/kitten'
-    elif age <= 3:
-        return 'adolescent'
-    elif age <= 7:
-        return 'adulthood'
-    elif age <= 10:
-        return 'senior'
-    else:
-        return 'super senior'
+    return compact_shelter_frame(final_data)
 
-def separate_breed(value):
-    value = value.lower()
-    
-    if 'mix' in value:
-        value = value.split(' mix')[0]
-        is_mix_breed = 'yes'
-    elif '/' in value:
-        value = value.split('/')[0]
-        is_mix_breed = 'yes'
-    else:
-        value = value
-        is_mix_breed = 'no'
-    
-    return value, is_mix_breed
+# Compact schema of the cleaned shelter frame: categoricals for the enumerations, booleans for the flags
+# and small integers for month, year, age and days. The pipeline produces these types directly,
+# compact_shelter_frame only converts what is not in that form yet (e.g. merged partitions, older files).
+SHELTER_CATEGORICAL_COLUMNS = ['animal_type', 'intake_type', 'intake_condition', 'outcome_type', 'gender', 'intact_status', 'age_group', 'breed', 'colour']
+SHELTER_FLAG_COLUMNS = ['is_mix_breed', 'is_multicolour', 'is_black', 'is_white', 'is_brown', 'is_yellow', 'is_gray']
+SHELTER_SMALL_INT_COLUMNS = {'outcome_month': 'int8', 'outcome_year': 'int16', 'days_in_shelter': 'int16'}
 
-def separate_colour(value):
-    value = value.lower()
-    
-    if '/' in value:
-        value = value.split('/')[0]
-        is_multicolour = 'yes'
-    elif 'tricolor' in value:
-        value = value.split('/')[0]
-        is_multicolour = 'yes'
-    else:
-        value = value
-        is_multicolour = 'no'
-    
-    return value, is_multicolour
+def compact_shelter_frame(data):
+    for col in SHELTER_CATEGORICAL_COLUMNS:
+        if col in data.columns and not isinstance(data[col].dtype, pd.CategoricalDtype):
+            data[col] = data[col].astype('category')
 
-def update_multicolour(row):
-    colour = ['agouti', 'point', 'tick', 'calico', 'brindle', 'torbie', 'tortie', 'sable', 'merle']
-    
-    if any(color in row['colour'].lower() for color in colour):
-        return 'yes'
+    for col in SHELTER_FLAG_COLUMNS:
+        if col in data.columns and data[col].dtype != bool:
+            data[col] = data[col].isin([True, 'yes'])
+
+    for col, dtype in SHELTER_SMALL_INT_COLUMNS.items():
+        if col in data.columns and data[col].dtype != dtype:
+            data[col] = data[col].astype(dtype)
+
+    if 'age' in data.columns:
+        data['age'] = downcast_age(data['age'])
+
+    return data
+
+# Whole-year ages fit in a small integer, fractional ages (from numeric files) are kept as float32
+def downcast_age(age):
+    if (age % 1 == 0).all():
+        return pd.to_numeric(age, downcast='integer')
+    return pd.to_numeric(age, downcast='float')
+
+# Flags written out as 'yes'/'no' for CSV exports, as the original files use
+def flags_to_yes_no(data):
+    for col in SHELTER_FLAG_COLUMNS:
+        if col in data.columns and data[col].dtype == bool:
+            data[col] = yes_no(data[col])
+    return data
+
+def memory_per_row(data):
+    return data.memory_usage(deep=True).sum() / max(len(data), 1)
+
+# Plotly groups categorical columns by every category, including ones with no rows left after
+# filtering, so hand it plain values instead
+def plain_categories(data):
+    categorical_cols = [col for col in data.columns if isinstance(data[col].dtype, pd.CategoricalDtype)]
+    return data.astype({col: object for col in categorical_cols})
+
+# Lowercase a text column into a categorical, lowercasing each distinct value once
+def to_lower_categorical(values):
+    codes, uniques = pd.factorize(values)
+    lowered = pd.Categorical(pd.Series(np.asarray(uniques, dtype=object), dtype=object).str.lower())
+    lowered_codes = np.where(codes == -1, -1, lowered.codes[codes] if len(lowered) else codes)
+    return pd.Series(pd.Categorical.from_codes(lowered_codes, lowered.categories), index=values.index)
+
+# Keyword tables used to derive the colour features
+# Colours that make an animal multicolour even without a '/' in the colour name
+MULTICOLOUR_KEYWORDS = ['tricolor', 'agouti', 'point', 'tick', 'calico', 'brindle', 'torbie', 'tortie', 'sable', 'merle']
+
+COLOUR_FLAG_KEYWORDS = {
+    'is_black': ['black'],
+    'is_white': ['white'],
+    'is_brown': ['brown', 'liver', 'chocolate', 'ruddy', 'red'],
+    'is_yellow': ['yellow', 'apricot', 'cream', 'buff', 'fawn', 'gold', 'tan'],
+    'is_gray': ['gray', 'blue', 'silver', 'lynx', 'lilac'],
+}
+
+def keyword_pattern(keywords):
+    return '|'.join(re.escape(keyword) for keyword in keywords)
+
+def yes_no(mask):
+    return np.where(mask, 'yes', 'no')
+
+# Columns like gender, breed and colour only have a few hundred distinct values, so the features are
+# derived once per unique value with vectorized string operations and then broadcast back to every row
+def derive_from_unique_values(values, derive_function):
+    codes, uniques = pd.factorize(values)
+
+    # Missing values get code -1, which picks up the features of a missing value appended at the end.
+    # Without any values the missing-value features still give the columns of the empty result.
+    missing_features = derive_function(pd.Series([np.nan], dtype=object))
+    if len(uniques) == 0:
+        features = missing_features
     else:
-        return row['is_multicolour']
+        features = derive_function(pd.Series(np.asarray(uniques, dtype=object), dtype=object))
+        if (codes == -1).any():
+            features = pd.concat([features, missing_features], ignore_index=True)
 
-def separate_colour_columns(colour):
-    colour = colour.lower()
-    
-    is_black = 'yes' if 'black' in colour else 'no'
-    is_white = 'yes' if 'white' in colour else 'no'
-    is_brown = 'yes' if any(color in colour for color in ['brown', 'liver', 'chocolate', 'ruddy', 'red']) else 'no'
-    is_yellow = 'yes' if any(color in colour for color in ['yellow', 'apricot', 'cream', 'buff', 'fawn', 'gold', 'tan']) else 'no'
-    is_gray = 'yes' if any(color in colour for color in ['gray', 'blue', 'silver', 'lynx', 'lilac']) else 'no'
-    
-    return is_black, is_white, is_brown, is_yellow, is_gray
+    # Text features become categoricals, so taking them for every row only copies the codes
+    for col in features.columns:
+        if features[col].dtype == object:
+            features[col] = features[col].astype('category')
 
+    features = features.iloc[codes]
+    features.index = values.index
+    return features
 
+# Gender and intact status from values like "Neutered Male", "Spayed Female" or "Intact Male"
+def derive_gender_and_intact_status(values):
+    value = values.str.lower()
 
-# Dashboard functions
-def card_metrics(intakes, adoptions, save_rate, live_release_rate):
-    kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-    kpi1.metric(
-            label="Number of Intakes",
-            value= int(intakes)
-        )
+    is_neutered = value.str.contains('neutered', regex=False, na=False).to_numpy()
+    is_spayed = value.str.contains('spayed', regex=False, na=False).to_numpy()
+    is_intact = value.str.contains('intact', regex=False, na=False).to_numpy()
 
-    kpi2.metric(
-        label="Number of Adoptions",
-        value= int(adoptions)
-    )
-    kpi3.metric(
-            label="Save Rate",
-            value=f"{save_rate:.2%}"
-        )
+    # second word of the value, e.g. "intact male" -> "male"
+    second_word = value.str.extract(r'^[^ ]* ([^ ]*)', expand=False)
+    intact_male = is_intact & (second_word == 'male').to_numpy()
+    intact_female = is_intact & (second_word == 'female').to_numpy()
 
-    kpi4.metric(
-        label="Live Release Rate",
-        value=f"{live_release_rate:.2%}"
-    )
+    gender = np.select([is_neutered, is_spayed, intact_male, intact_female],
+                       ['male', 'female', 'male', 'female'], default='unknown')
+    intact_status = np.select([is_neutered, is_spayed, intact_male | intact_female],
+                              ['neutered', 'spayed', 'intact'], default='unknown')
 
-def plot_graphs_sample(df):
+    return pd.DataFrame({'gender': gender, 'intact_status': intact_status}, dtype=object)
 
-    adoption_data = df[df['outcome_type'] == 'adoption']
-    adoption_counts_year = adoption_data[['outcome_year', 'animal_type']].value_counts().reset_index(name='count')
-    adoption_counts_year = adoption_counts_year.sort_values(['animal_type', 'outcome_year'])
+# Breed without " mix" or the second breed after "/", and whether the animal is a mix breed
+def derive_breed(values):
+    value = values.str.lower()
 
-    adoption_counts_month = adoption_data[['outcome_month', 'animal_type']].value_counts().reset_index(name='count')
-    adoption_counts_month = adoption_counts_month.sort_values(['animal_type', 'outcome_month'])
+    has_mix = value.str.contains('mix', regex=False, na=False).to_numpy()
+    has_slash = value.str.contains('/', regex=False, na=False).to_numpy()
 
-    st.markdown("### Cats and Dogs Adoptions")
-    fig1 = px.line(adoption_counts_year, x='outcome_year', y = 'count', color='animal_type', markers=True)
-    fig1.update_layout(
-        xaxis_title="",
-        yaxis_title="Adoption Count"
-    )
+    breed = np.select([has_mix, has_slash],
+                      [value.str.partition(' mix')[0].to_numpy(), value.str.partition('/')[0].to_numpy()],
+                      default=value.to_numpy())
 
-    fig2 = px.line(adoption_counts_month, x='outcome_month', y = 'count', color='animal_type', markers=True)
-    fig2.update_layout(
-        xaxis_title="",
-        yaxis_title="Adoption Count"
-    )
+    return pd.DataFrame({'breed': pd.Series(breed, dtype=object), 'is_mix_breed': has_mix | has_slash})
 
+# First colour before "/", whether the animal is multicolour and the colour flags, as booleans
+def derive_colour(values):
+    value = values.str.lower()
 
-    st.write('')
-    adoption_data['outcome_date_time'] = pd.to_datetime(adoption_data['outcome_date_time'])
-    counts = adoption_data['outcome_date_time'].dt.day_name().value_counts()
-    percentage = counts / counts.sum() *100
-    # Create a new DataFrame with 'Day' and 'Percentage' columns
-    adoption_day_df = pd.DataFrame({'Day': percentage.index, 'Percentage': percentage.values})
+    colour_features = pd.DataFrame({
+        'colour': pd.Series(value.str.partition('/')[0].to_numpy(), dtype=object),
+        'is_multicolour': value.str.contains('/|' + keyword_pattern(MULTICOLOUR_KEYWORDS), na=False).to_numpy(),
+    })
 
-    # Sort the DataFrame by 'Day' in chronological order
-    day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    adoption_day_df['Day'] = pd.Categorical(adoption_day_df['Day'], categories=day_order, ordered=True)
-    adoption_day_df.sort_values(by='Day', inplace=True)
+    for flag, keywords in COLOUR_FLAG_KEYWORDS.items():
+        colour_features[flag] = value.str.contains(keyword_pattern(keywords), na=False).to_numpy()
 
-    fig5 = px.bar(adoption_day_df, x='Day', y='Percentage', color='Day')
-    fig5.update_layout(xaxis_title="", yaxis_title="Percentage of Adoptions (%)")
+    return colour_features
 
-    tab1, tab2, tab3 = st.tabs(["Adoption By Year", "Adoption By Month", "Preferred Day for Adoption"])
-    with tab1:
-        st.plotly_chart(fig1)
-    with tab2:
-        st.plotly_chart(fig2)
-    with tab3:
-        st.plotly_chart(fig5)
+# Number of days in each age unit, ages without a unit are taken to be in years
+AGE_UNIT_DAYS = {'year': 365, 'month': 30, 'week': 7, 'day': 1}
 
+# Age group bins in years, right-inclusive (an age of exactly 1 year is a puppy/kitten)
+AGE_GROUP_BINS = [-np.inf, 1, 3, 7, 10, np.inf]
+AGE_GROUP_LABELS = ['puppy/kitten', 'adolescent', 'adulthood', 'senior', 'super senior']
 
-    # Calculate the average length of stay by year and animal type
-    avg_los_year = df.groupby(['outcome_year', 'animal_type'])['days_in_shelter'].mean().reset_index(name='avg_los')
-    avg_los_year = avg_los_year.sort_values(['animal_type', 'outcome_year'])
+# Vectorized age parser, handles numeric ages and "N years/months/weeks/days" text in the same column
+def parse_age_years(age):
+    if pd.api.types.is_numeric_dtype(age):
+        return age
 
-    avg_los_month = df.groupby(['outcome_month', 'animal_type'])['days_in_shelter'].mean().reset_index(name='avg_los')
-    avg_los_month = avg_los_month.sort_values(['animal_type', 'outcome_month'])
+    age_parts = age.astype(str).str.lower().str.extract(r'(\d+(?:\.\d+)?)\s*(year|month|week|day)?')
+    number = pd.to_numeric(age_parts[0], errors='coerce')
+    unit = age_parts[1]
 
-    st.markdown("### Average Length of Stay")
-    fig3 = px.line(avg_los_year, x='outcome_year', y='avg_los', color='animal_type', markers=True)
-    fig3.update_layout(xaxis_title="", yaxis_title="Average Length of Stay (Days)")
+    age_years = (number * unit.map(AGE_UNIT_DAYS)) // 365
+    return age_years.where(unit.notna(), number)
 
-    fig4 = px.line(avg_los_month, x='outcome_month', y='avg_los', color='animal_type', markers=True)
-    fig4.update_layout(xaxis_title="", yaxis_title="Average Length of Stay (Days)")
+def make_age_group(age_years):
+    return pd.cut(age_years, bins=AGE_GROUP_BINS, labels=AGE_GROUP_LABELS, ordered=True)
 
-    tab3, tab4 = st.tabs(["LOS By Year", "LOS By Month"])
-    with tab3:
-        st.plotly_chart(fig3)
-    with tab4:
-        st.plotly_chart(fig4)
-    
 
 
-    st.markdown("### Intake Types")
-    intake_data = df['intake_type'].value_counts()
-    
-    # intake_data_df = pd.DataFrame({'Intake Type': intake_data['index'], 'Count': intake_data['Count']})
-    x = intake_data.index.tolist()
-    y = intake_data.values.tolist()
-    
-    fig6 = go.Figure(data=[go.Pie(labels=x, values = y, hole=0.45,
-                                marker_colors=px.colors.diverging.Portland,
-                                textinfo='label+percent')])
-    st.plotly_chart(fig6)
+# Dashboard functions
+def card_metrics(intakes, adoptions, save_rate, live_release_rate, trend=None):
+    # The deltas compare the last complete month with the month before, see kpi_trend
+    deltas = {key: None for key in ['total_num_intakes', 'total_num_adoptions', 'save_rate', 'live_release_rate']}
+    delta_help = None
+    if trend is not None:
+        deltas = {
+            'total_num_intakes': trend['total_num_intakes'],
+            'total_num_adoptions': trend['total_num_adoptions'],
+            'save_rate': None if pd.isnull(trend['save_rate']) else f"{trend['save_rate']:+.2%}",
+            'live_release_rate': None if pd.isnull(trend['live_release_rate']) else f"{trend['live_release_rate']:+.2%}",
+        }
+        delta_help = (f"All-time total. The change is {trend['period']} compared with {trend['previous_period']}, by month of intake. "
+                      f"{trend['partial_period']} is left out because it may be partial.")
 
-    st.markdown("### Outcome Types")
-    outcome_data = df['outcome_type'].value_counts()
-    
-    # intake_data_df = pd.DataFrame({'Intake Type': intake_data['index'], 'Count': intake_data['Count']})
-    x = outcome_data.index.tolist()
-    y = outcome_data.values.tolist()
-    
-    fig8 = go.Figure(data=[go.Pie(labels=x, values = y, hole=0.45,
-                                marker_colors=px.colors.diverging.Temps,
-                                textinfo='label+percent')])
-    st.plotly_chart(fig8)
+    kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+    kpi1.metric(
+            label="Number of Intakes",
+            value= int(intakes),
+            delta=deltas['total_num_intakes'],
+            help=delta_help
+        )
 
-    
-    st.markdown("### Animal Characteristics Analysis")
-    #### plot animal breed in LOS - which top 10 dog/cat breed has a longer LOS
-    dog_data = df[df['animal_type'] == 'dog']
-    cat_data = df[df['animal_type'] == 'cat']
-
-    selected_tab = st.selectbox("Analyse Animal Breed, Gender, Colour: ", ["Top 10 Dog Breed By LOS", 
-                                               "Top 10 Cat Breed By LOS", 
-                                               "Top 10 Adopted Dog Breed",
-                                               "Top 10 Adopted Cat Breed",
-                                               "Gender Analysis",
-                                               "Colour Analysis"])
-
-    if selected_tab == "Top 10 Dog Breed By LOS":
-        # sort the dog breed by average length of stay
-        dog_breed_los = dog_data.groupby(['primary_breed'])['days_in_shelter'].mean().reset_index(name='avg_los')
-        dog_breed_los = dog_breed_los.sort_values(['avg_los'], ascending=False)
-
-        # only show top 10 dog breed
-        dog_breed_los = dog_breed_los.head(10)
-        fig7 = px.bar(dog_breed_los, x='primary_breed', y='avg_los', color='primary_breed')
-        fig7.update_layout(yaxis_title="Average Length of Stay (Days)")
-        st.plotly_chart(fig7)
-    
-    elif selected_tab == "Top 10 Cat Breed By LOS":
+    kpi2.metric(
+        label="Number of Adoptions",
+        value= int(adoptions),
+        delta=deltas['total_num_adoptions'],
+        help=delta_help
+    )
+    kpi3.metric(
+            label="Save Rate",
+            value=f"{save_rate:.2%}",
+            delta=deltas['save_rate'],
+            help=delta_help
+        )
 
-        # sort the cat breed by average length of stay
-        cat_breed_los = cat_data.groupby(['primary_breed'])['days_in_shelter'].mean().reset_index(name='avg_los')
-        cat_breed_los = cat_breed_los.sort_values(['avg_los'], ascending=False)
+    kpi4.metric(
+        label="Live Release Rate",
+        value=f"{live_release_rate:.2%}",
+        delta=deltas['live_release_rate'],
+        help=delta_help
+    )
 
-        # only show top 10 cat breed
-        cat_breed_los = cat_breed_los.head(10)
+# Save rate and live release rate per month, year or animal type, from the KPI accumulator
+def plot_kpi_breakdown(accumulator):
+    if accumulator is None:
+        return
+    st.markdown("### Save Rate and Live Release Rate")
+    plot_chart_section(KPI_CHART_VIEWS, accumulator, frame_fingerprint(accumulator), label='Save Rate and Live Release Rate')
+
+def kpi_rate_chart(breakdown, x):
+    rates = breakdown.melt(id_vars=[x], value_vars=['save_rate', 'live_release_rate'], var_name='metric', value_name='rate')
+    rates['metric'] = rates['metric'].map({'save_rate': 'Save Rate', 'live_release_rate': 'Live Release Rate'})
+    rates['rate'] = rates['rate'] * 100
+    return rates
+
+def chart_kpi_by_month(accumulator):
+    breakdown = kpi_breakdown(accumulator, 'month')
+    breakdown['period'] = breakdown['period'].astype(str)
+    fig = px.line(kpi_rate_chart(breakdown, 'period'), x='period', y='rate', color='metric', markers=True)
+    fig.update_layout(xaxis_title="", yaxis_title="Rate (%)", legend_title_text="")
+    return [fig]
+
+def chart_kpi_by_year(accumulator):
+    fig = px.line(kpi_rate_chart(kpi_breakdown(accumulator, 'year'), 'year'), x='year', y='rate', color='metric', markers=True)
+    fig.update_layout(xaxis_title="", yaxis_title="Rate (%)", legend_title_text="")
+    return [fig]
+
+def chart_kpi_by_animal_type(accumulator):
+    fig = px.bar(kpi_rate_chart(kpi_breakdown(accumulator, 'animal_type'), 'animal_type'), x='animal_type', y='rate', color='metric', barmode='group')
+    fig.update_layout(xaxis_title="", yaxis_title="Rate (%)", legend_title_text="")
+    return [fig]
+
+KPI_CHART_VIEWS = {
+    'By Month': chart_kpi_by_month,
+    'By Year': chart_kpi_by_year,
+    'By Animal Type': chart_kpi_by_animal_type,
+}
+
+# Pre-aggregated metrics cube behind the Analytics Dashboard.
+# Every dashboard chart is a slice of this cube, so reruns do not go back to the row-level data.
+METRICS_CUBE_DIMENSIONS = ['animal_type', 'outcome_year', 'outcome_month', 'weekday', 'intake_type', 'outcome_type', 'breed', 'colour', 'gender']
+METRICS_CUBE_MEASURES = ['count', 'los_sum', 'los_count']
+
+def build_metrics_cube(df, breed_col='breed', colour_col='colour'):
+    cube_data = pd.DataFrame({
+        'animal_type': df['animal_type'],
+        'outcome_year': df['outcome_year'],
+        'outcome_month': df['outcome_month'],
+        'weekday': pd.to_datetime(df['outcome_date_time']).dt.day_name(),
+        'intake_type': df['intake_type'],
+        'outcome_type': df['outcome_type'],
+        'breed': df[breed_col],
+        'colour': df[colour_col],
+        'gender': df['gender'],
+        'days_in_shelter': df['days_in_shelter'],
+    })
 
-        fig10 = px.bar(cat_breed_los, x='primary_breed', y='avg_los', color='primary_breed')
-        fig10.update_layout(yaxis_title="Average Length of Stay (Days)")
-        st.plotly_chart(fig10)
-    
-    elif selected_tab == "Top 10 Adopted Dog Breed":
-        #### plot animal breed by adoption - which top 10 dog/cat breed has the highest adoption rate
-        dog_breed_adoption = dog_data.groupby(['primary_breed'])['outcome_type'].value_counts().reset_index(name='count')
-        dog_breed_adoption = dog_breed_adoption[dog_breed_adoption['outcome_type'] == 'adoption']
-        dog_breed_adoption = dog_breed_adoption.sort_values(['count'], ascending=False)
-        dog_breed_adoption = dog_breed_adoption.head(10)
-        fig9 = px.bar(dog_breed_adoption, x='primary_breed', y='count', color='primary_breed')
-        fig9.update_layout(yaxis_title="Adoption Count")
-        st.plotly_chart(fig9)
-
-
-    elif selected_tab == "Top 10 Adopted Cat Breed":
-        cat_breed_adoption = cat_data.groupby(['primary_breed'])['outcome_type'].value_counts().reset_index(name='count')
-        cat_breed_adoption = cat_breed_adoption[cat_breed_adoption['outcome_type'] == 'adoption']
-        cat_breed_adoption = cat_breed_adoption.sort_values(['count'], ascending=False)
-        cat_breed_adoption = cat_breed_adoption.head(10)
-        fig11 = px.bar(cat_breed_adoption, x='primary_breed', y='count', color='primary_breed')
-        fig11.update_layout(yaxis_title="Adoption Count")
-        st.plotly_chart(fig11)
-    
-    elif selected_tab =="Gender Analysis":
-        # Group the data by gender and calculate the counts for cat_data
-        cat_gender_data = cat_data['gender'].value_counts().reset_index(name='Count')
-        cat_gender_data.rename(columns={'index': 'gender'}, inplace=True)
-        cat_gender_data['animal_type'] = 'cat'
-
-        # Group the data by gender and calculate the counts for dog_data
-        dog_gender_data = dog_data['gender'].value_counts().reset_index(name='Count')
-        dog_gender_data.rename(columns={'index': 'gender'}, inplace=True)
-        dog_gender_data['animal_type'] = 'dog'
-
-        # Combine the data for both cat and dog
-        combined_data = pd.concat([cat_gender_data, dog_gender_data])
-
-        # Create the stacked bar chart
-        fig12 = px.bar(combined_data, x='animal_type', y='Count', color='gender', barmode='stack', text='Count')
-
-        # Update layout to set the title and axis labels
-        fig12.update_layout(title='Stacked Bar Chart of Dog and Cat Gender', xaxis_title='', yaxis_title='Count')
-        st.plotly_chart(fig12)
-    
-    elif selected_tab == "Colour Analysis":
-        # Group the data by primary_colour and calculate the counts for cat_data
-        cat_colour_data = cat_data['primary_colour'].value_counts().reset_index(name='Count')
-        cat_colour_data = cat_colour_data.sort_values(['Count'], ascending=False)
-        cat_colour_data = cat_colour_data.head(10)
-        cat_colour_data.rename(columns={'index': 'primary_colour'}, inplace=True)
-        cat_colour_data['animal_type'] = 'cat'
+    cube = cube_data.groupby(METRICS_CUBE_DIMENSIONS, dropna=False, observed=True).agg(
+        count=('days_in_shelter', 'size'),
+        los_sum=('days_in_shelter', 'sum'),
+        los_count=('days_in_shelter', 'count'),
+    )
+    return cube.reset_index()
+
+# Update a cube for removed and added records: the removed records are subtracted from their cells,
+# the added records are added, and cells left without records are dropped
+def update_metrics_cube(cube, removed_data, added_data, breed_col='breed', colour_col='colour'):
+    removed_cube = build_metrics_cube(removed_data, breed_col, colour_col)
+    removed_cube[METRICS_CUBE_MEASURES] = -removed_cube[METRICS_CUBE_MEASURES]
+    cubes = [plain_categories(part) for part in (cube, removed_cube, build_metrics_cube(added_data, breed_col, colour_col))]
+
+    cube = pd.concat(cubes, ignore_index=True).groupby(METRICS_CUBE_DIMENSIONS, dropna=False)[METRICS_CUBE_MEASURES].sum()
+    cube = cube[cube['count'] != 0].reset_index()
+    return cube
+
+# Build the cube once per dataset and keep it in the session, keyed by the dataset fingerprint
+# The cube is kept in the dataset store, keyed by the fingerprint of its dataset, so sessions on the same
+# dataset share one cube and the session keeps nothing but its dataset key
+def metrics_cube_key(dataset_key, breed_col='breed', colour_col='colour'):
+    return f'{dataset_key}-cube-{breed_col}-{colour_col}'
+
+def get_metrics_cube(df, breed_col='breed', colour_col='colour'):
+    cube_key = metrics_cube_key(frame_fingerprint(df), breed_col, colour_col)
+    cube = get_dataset(cube_key)
+    if cube is None:
+        put_dataset(build_metrics_cube(df, breed_col, colour_col), cube_key)
+        cube = get_dataset(cube_key)
+    return cube
+
+# Sum the cube measures by the given dimensions, after filtering on dimension values
+def slice_metrics_cube(cube, by, **filters):
+    for col, value in filters.items():
+        cube = cube[cube[col] == value]
+    totals = cube.groupby(by, observed=True)[METRICS_CUBE_MEASURES].sum().reset_index()
+    totals['avg_los'] = totals['los_sum'] / totals['los_count']
+    return plain_categories(totals)
 
+def plot_graphs_sample(df):
+    plot_dashboard(get_metrics_cube(df, breed_col='primary_breed', colour_col='primary_colour'))
 
-        # Group the data by primary_colour and calculate the counts for dog_data
-        dog_colour_data = dog_data['primary_colour'].value_counts().reset_index(name='Count')
-        dog_colour_data.rename(columns={'index': 'primary_colour'}, inplace=True)
-        dog_colour_data = dog_colour_data.sort_values(['Count'], ascending=False)
-        dog_colour_data = dog_colour_data.head(10)
-        dog_colour_data['animal_type'] = 'dog'
+def plot_graphs_cleaned_data(df):
+    plot_dashboard(get_metrics_cube(df))
+
+# Snapshot of the sample-mode dashboard: the KPI accumulator and the metrics cube of the bundled sample dataset.
+# It is built ahead of time with build_sample_snapshot.py, so sample mode never touches row-level data.
+# Bump SAMPLE_SNAPSHOT_VERSION whenever the snapshot layout changes.
+SAMPLE_SNAPSHOT_VERSION = 4
+SAMPLE_SNAPSHOT_PATH = os.path.join(ARTIFACT_DIR, 'sample_dashboard_snapshot.joblib')
+
+_sample_dashboard_snapshot = None
+_sample_dashboard_snapshot_lock = threading.Lock()
+
+def build_sample_dashboard_snapshot(path=SAMPLE_DATASET_PATH):
+    with open(path, 'rb') as f:
+        data = read_csv_columns(f, upload_columns(pd.read_csv(path, nrows=0).columns))
+
+    # Same steps as the cleaning pipeline, run without writing to the session state
+    kept_columns = plan_missing_data(data)[0].tolist()
+    data['_row_position'] = np.arange(len(data))
+    cleaned_data, kpi_accumulator, _, _, _ = preprocess_partition(data, kept_columns)
+
+    return {
+        'version': SAMPLE_SNAPSHOT_VERSION,
+        'pipeline_version': PIPELINE_VERSION,
+        # Pickled frames are only read back reliably by the pandas version that wrote them
+        'pandas_version': pd.__version__,
+        'source_hash': file_hash(path),
+        'kpi_accumulator': kpi_accumulator,
+        'cube': build_metrics_cube(cleaned_data.drop(columns='_row_position')),
+    }
+
+def save_sample_dashboard_snapshot(path=SAMPLE_SNAPSHOT_PATH):
+    snapshot = build_sample_dashboard_snapshot()
+    dump(snapshot, path)
+    return snapshot
+
+def is_sample_dashboard_snapshot_current(snapshot):
+    return (isinstance(snapshot, dict)
+            and snapshot.get('version') == SAMPLE_SNAPSHOT_VERSION
+            and snapshot.get('pipeline_version') == PIPELINE_VERSION
+            and snapshot.get('pandas_version') == pd.__version__
+            and snapshot.get('source_hash') == file_hash(SAMPLE_DATASET_PATH))
+
+# The saved snapshot, or None if it is missing or cannot be read (e.g. a corrupt file, or one pickled by
+# a pandas version that cannot unpickle it here)
+def load_sample_dashboard_snapshot():
+    if not os.path.exists(SAMPLE_SNAPSHOT_PATH):
+        return None
+    try:
+        return load(SAMPLE_SNAPSHOT_PATH)
+    except Exception as e:
+        logging.getLogger(__name__).warning('Could not load %s: %s', os.path.basename(SAMPLE_SNAPSHOT_PATH), e)
+        return None
+
+# Load the snapshot once per process. A missing, unreadable or outdated snapshot is rebuilt in memory from the
+# sample dataset, so the page still works (more slowly, once) until build_sample_snapshot.py is run again.
+def get_sample_dashboard_snapshot():
+    global _sample_dashboard_snapshot
+
+    with _sample_dashboard_snapshot_lock:
+        if _sample_dashboard_snapshot is None:
+            snapshot = load_sample_dashboard_snapshot()
+            if not is_sample_dashboard_snapshot_current(snapshot):
+                logging.getLogger(__name__).warning('%s is missing, unreadable or outdated, rebuilding it in memory. Run build_sample_snapshot.py to update it.',
+                                                    os.path.basename(SAMPLE_SNAPSHOT_PATH))
+                snapshot = build_sample_dashboard_snapshot()
+            _sample_dashboard_snapshot = snapshot
+        return _sample_dashboard_snapshot
+
+def plot_sample_dashboard():
+    snapshot = get_sample_dashboard_snapshot()
+    kpis = kpi_totals(snapshot['kpi_accumulator'])
+    card_metrics(kpis['total_num_intakes'], kpis['total_num_adoptions'], kpis['save_rate'], kpis['live_release_rate'],
+                 kpi_trend(snapshot['kpi_accumulator']))
+    plot_kpi_breakdown(snapshot['kpi_accumulator'])
+    plot_dashboard(snapshot['cube'])
+
+# Chart registry: every chart view is a named builder that returns its figures. A section only builds
+# the view that is selected, and built figures are kept keyed by the builder, the dataset fingerprint and
+# the filter state, so reruns that do not change them reuse the figures. The cache is shared by all sessions
+# (sessions on the same data see the same charts) and keeps the CHART_CACHE_MAX_ENTRIES most recently used
+# views. Cached figures are only read when they are shown, they must not be modified.
+CHART_CACHE_MAX_ENTRIES = int(os.environ.get('SHELTER_CHART_CACHE_MAX_ENTRIES', 64))
+
+_chart_cache = OrderedDict()
+_chart_cache_lock = threading.Lock()
+_frame_fingerprints = {}
+FRAME_FINGERPRINT_LENGTH = 16
+
+# Content hash of a frame, computed once per frame object
+def frame_fingerprint(df):
+    entry = _frame_fingerprints.get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+
+    sha256 = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    sha256.update(str(list(df.columns)).encode())
+    fingerprint = sha256.hexdigest()[:FRAME_FINGERPRINT_LENGTH]
+
+    remember_frame_fingerprint(df, fingerprint)
+    return fingerprint
+
+def is_frame_fingerprint(key):
+    return re.fullmatch(f'[0-9a-f]{{{FRAME_FINGERPRINT_LENGTH}}}', key) is not None
+
+# Frames read back from a known source (e.g. a dataset store spill) get their fingerprint without hashing
+def remember_frame_fingerprint(df, fingerprint):
+    frame_id = id(df)
+    _frame_fingerprints[frame_id] = (weakref.ref(df, lambda _: _frame_fingerprints.pop(frame_id, None)), fingerprint)
+
+def get_chart(build_chart, data, dataset_key=None, filter_key=None):
+    # Without a dataset key there is nothing to tell datasets apart by, so the chart is always built
+    if dataset_key is None:
+        return build_chart(data)
+
+    cache_key = (build_chart.__name__, dataset_key, filter_key)
+    with _chart_cache_lock:
+        figures = _chart_cache.get(cache_key)
+        if figures is not None:
+            _chart_cache.move_to_end(cache_key)
+            return figures
+
+    # Built without the lock, two sessions asking for the same new view at once may both build it
+    figures = build_chart(data)
+    with _chart_cache_lock:
+        _chart_cache[cache_key] = figures
+        while len(_chart_cache) > CHART_CACHE_MAX_ENTRIES:
+            _chart_cache.popitem(last=False)
+    return figures
+
+# Show one view of a chart section. st.tabs runs the code of every tab on each rerun, so the views are
+# picked with a radio (or selectbox) and only the selected view is built and sent to the browser.
+def plot_chart_section(views, data, dataset_key=None, filter_key=None, label=None, use_selectbox=False):
+    view_names = list(views)
+    if len(view_names) == 1:
+        selected_view = view_names[0]
+    elif use_selectbox:
+        selected_view = st.selectbox(label, view_names)
+    else:
+        selected_view = st.radio(label, view_names, horizontal=True, label_visibility='collapsed')
 
-        # Combine the data for both cat and dog
-        combined_data = pd.concat([cat_colour_data, dog_colour_data])
+    for fig in get_chart(views[selected_view], data, dataset_key, filter_key):
+        show_figure(fig)
+    return selected_view
 
-        fig13 = px.bar(cat_colour_data, x='animal_type', y='Count', color='primary_colour', text='Count',
-                    color_discrete_sequence=px.colors.diverging.Picnic)
-        fig13.update_layout(title='Stacked Bar Chart of Cat Colour', xaxis_title = "", yaxis_title='Count')
+# Serializing a figure and sending it to the browser, kept separate so profiling can time it
+def show_figure(fig):
+    st.plotly_chart(fig)
 
-        fig13.update_traces(textposition='inside')
+def plot_dashboard(cube):
+    dataset_key = frame_fingerprint(cube)
 
-        fig14 = px.bar(dog_colour_data, x='animal_type', y='Count', color='primary_colour', text='Count',
-                    color_discrete_sequence=px.colors.diverging.Picnic)
+    st.markdown("### Cats and Dogs Adoptions")
+    plot_chart_section(ADOPTION_CHART_VIEWS, cube, dataset_key, label='Adoptions')
 
-        fig14.update_layout(title='Stacked Bar Chart of Dog Colour', xaxis_title = "", yaxis_title='Count')
+    st.markdown("### Average Length of Stay")
+    plot_chart_section(LOS_CHART_VIEWS, cube, dataset_key, label='Average Length of Stay')
 
-        fig14.update_traces(textposition='inside')
+    st.markdown("### Intake Types")
+    plot_chart_section({'Intake Types': chart_intake_types}, cube, dataset_key)
 
-        # Show the chart
-        st.plotly_chart(fig13)
-        st.plotly_chart(fig14)
+    st.markdown("### Outcome Types")
+    plot_chart_section({'Outcome Types': chart_outcome_types}, cube, dataset_key)
 
-    time.sleep(1)
+    st.markdown("### Animal Characteristics Analysis")
+    #### plot animal breed in LOS - which top 10 dog/cat breed has a longer LOS
+    plot_chart_section(CHARACTERISTICS_CHART_VIEWS, cube, dataset_key, label="Analyse Animal Breed, Gender, Colour: ", use_selectbox=True)
 
-def plot_graphs_cleaned_data(df):
-    adoption_data = df[df['outcome_type'] == 'adoption']
-    adoption_counts_year = adoption_data[['outcome_year', 'animal_type']].value_counts().reset_index(name='count')
+# Analytics Dashboard chart builders, each takes the metrics cube and returns its figures
+def chart_adoption_by_year(cube):
+    adoption_counts_year = slice_metrics_cube(cube, ['outcome_year', 'animal_type'], outcome_type='adoption')
     adoption_counts_year = adoption_counts_year.sort_values(['animal_type', 'outcome_year'])
 
-    adoption_counts_month = adoption_data[['outcome_month', 'animal_type']].value_counts().reset_index(name='count')
-    adoption_counts_month = adoption_counts_month.sort_values(['animal_type', 'outcome_month'])
-
-    st.markdown("### Cats and Dogs Adoptions")
     fig1 = px.line(adoption_counts_year, x='outcome_year', y = 'count', color='animal_type', markers=True)
     fig1.update_layout(
         xaxis_title="",
         yaxis_title="Adoption Count"
     )
+    return [fig1]
+
+def chart_adoption_by_month(cube):
+    adoption_counts_month = slice_metrics_cube(cube, ['outcome_month', 'animal_type'], outcome_type='adoption')
+    adoption_counts_month = adoption_counts_month.sort_values(['animal_type', 'outcome_month'])
 
     fig2 = px.line(adoption_counts_month, x='outcome_month', y = 'count', color='animal_type', markers=True)
     fig2.update_layout(
         xaxis_title="",
         yaxis_title="Adoption Count"
     )
+    return [fig2]
 
-
-    st.write('')
-    adoption_data['outcome_date_time'] = pd.to_datetime(adoption_data['outcome_date_time'])
-    counts = adoption_data['outcome_date_time'].dt.day_name().value_counts()
+def chart_adoption_by_weekday(cube):
+    counts = slice_metrics_cube(cube, ['weekday'], outcome_type='adoption').set_index('weekday')['count']
     percentage = counts / counts.sum() *100
     # Create a new DataFrame with 'Day' and 'Percentage' columns
     adoption_day_df = pd.DataFrame({'Day': percentage.index, 'Percentage': percentage.values})
@@ -561,237 +1725,183 @@ def plot_graphs_cleaned_data(df):
 
     fig5 = px.bar(adoption_day_df, x='Day', y='Percentage', color='Day')
     fig5.update_layout(xaxis_title="", yaxis_title="Percentage of Adoptions (%)")
+    return [fig5]
 
-    tab1, tab2, tab3 = st.tabs(["Adoption By Year", "Adoption By Month", "Preferred Day for Adoption"])
-    with tab1:
-        st.plotly_chart(fig1)
-    with tab2:
-        st.plotly_chart(fig2)
-    with tab3:
-        st.plotly_chart(fig5)
-
-
+def chart_los_by_year(cube):
     # Calculate the average length of stay by year and animal type
-    avg_los_year = df.groupby(['outcome_year', 'animal_type'])['days_in_shelter'].mean().reset_index(name='avg_los')
+    avg_los_year = slice_metrics_cube(cube, ['outcome_year', 'animal_type'])
     avg_los_year = avg_los_year.sort_values(['animal_type', 'outcome_year'])
 
-    avg_los_month = df.groupby(['outcome_month', 'animal_type'])['days_in_shelter'].mean().reset_index(name='avg_los')
-    avg_los_month = avg_los_month.sort_values(['animal_type', 'outcome_month'])
-
-    st.markdown("### Average Length of Stay")
     fig3 = px.line(avg_los_year, x='outcome_year', y='avg_los', color='animal_type', markers=True)
     fig3.update_layout(xaxis_title="", yaxis_title="Average Length of Stay (Days)")
+    return [fig3]
+
+def chart_los_by_month(cube):
+    avg_los_month = slice_metrics_cube(cube, ['outcome_month', 'animal_type'])
+    avg_los_month = avg_los_month.sort_values(['animal_type', 'outcome_month'])
 
     fig4 = px.line(avg_los_month, x='outcome_month', y='avg_los', color='animal_type', markers=True)
     fig4.update_layout(xaxis_title="", yaxis_title="Average Length of Stay (Days)")
+    return [fig4]
 
-    tab3, tab4 = st.tabs(["LOS By Year", "LOS By Month"])
-    with tab3:
-        st.plotly_chart(fig3)
-    with tab4:
-        st.plotly_chart(fig4)
+def chart_intake_types(cube):
+    intake_data = slice_metrics_cube(cube, ['intake_type']).sort_values('count', ascending=False)
     
-
-
-    st.markdown("### Intake Types")
-    intake_data = df['intake_type'].value_counts()
-    
-    # intake_data_df = pd.DataFrame({'Intake Type': intake_data['index'], 'Count': intake_data['Count']})
-    x = intake_data.index.tolist()
-    y = intake_data.values.tolist()
+    x = intake_data['intake_type'].tolist()
+    y = intake_data['count'].tolist()
     
     fig6 = go.Figure(data=[go.Pie(labels=x, values = y, hole=0.45,
                                 marker_colors=px.colors.diverging.Portland,
                                 textinfo='label+percent')])
-    st.plotly_chart(fig6)
+    return [fig6]
 
-    st.markdown("### Outcome Types")
-    outcome_data = df['outcome_type'].value_counts()
+def chart_outcome_types(cube):
+    outcome_data = slice_metrics_cube(cube, ['outcome_type']).sort_values('count', ascending=False)
     
-    # intake_data_df = pd.DataFrame({'Intake Type': intake_data['index'], 'Count': intake_data['Count']})
-    x = outcome_data.index.tolist()
-    y = outcome_data.values.tolist()
+    x = outcome_data['outcome_type'].tolist()
+    y = outcome_data['count'].tolist()
     
     fig8 = go.Figure(data=[go.Pie(labels=x, values = y, hole=0.45,
                                 marker_colors=px.colors.diverging.Temps,
                                 textinfo='label+percent')])
-    st.plotly_chart(fig8)
+    return [fig8]
+
+def chart_top_dog_breed_by_los(cube):
+    # sort the dog breed by average length of stay
+    dog_breed_los = slice_metrics_cube(cube, ['breed'], animal_type='dog')
+    dog_breed_los = dog_breed_los.sort_values(['avg_los'], ascending=False)
+
+    # only show top 10 dog breed
+    dog_breed_los = dog_breed_los.head(10)
+    fig7 = px.bar(dog_breed_los, x='breed', y='avg_los', color='breed')
+    fig7.update_layout(yaxis_title="Average Length of Stay (Days)")
+    return [fig7]
+
+def chart_top_cat_breed_by_los(cube):
+    # sort the cat breed by average length of stay
+    cat_breed_los = slice_metrics_cube(cube, ['breed'], animal_type='cat')
+    cat_breed_los = cat_breed_los.sort_values(['avg_los'], ascending=False)
+
+    # only show top 10 cat breed
+    cat_breed_los = cat_breed_los.head(10)
+
+    fig10 = px.bar(cat_breed_los, x='breed', y='avg_los', color='breed')
+    fig10.update_layout(yaxis_title="Average Length of Stay (Days)")
+    return [fig10]
+
+def chart_top_adopted_dog_breed(cube):
+    #### plot animal breed by adoption - which top 10 dog/cat breed has the highest adoption rate
+    dog_breed_adoption = slice_metrics_cube(cube, ['breed'], animal_type='dog', outcome_type='adoption')
+    dog_breed_adoption = dog_breed_adoption.sort_values(['count'], ascending=False)
+    dog_breed_adoption = dog_breed_adoption.head(10)
+    fig9 = px.bar(dog_breed_adoption, x='breed', y='count', color='breed')
+    fig9.update_layout(yaxis_title="Adoption Count")
+    return [fig9]
+
+def chart_top_adopted_cat_breed(cube):
+    cat_breed_adoption = slice_metrics_cube(cube, ['breed'], animal_type='cat', outcome_type='adoption')
+    cat_breed_adoption = cat_breed_adoption.sort_values(['count'], ascending=False)
+    cat_breed_adoption = cat_breed_adoption.head(10)
+    fig11 = px.bar(cat_breed_adoption, x='breed', y='count', color='breed')
+    fig11.update_layout(yaxis_title="Adoption Count")
+    return [fig11]
+
+def chart_cat_dog_gender(cube):
+    # Group the data by gender and calculate the counts for cats and dogs
+    cat_gender_data = slice_metrics_cube(cube, ['gender'], animal_type='cat').rename(columns={'count': 'Count'})
+    cat_gender_data['animal_type'] = 'cat'
+
+    dog_gender_data = slice_metrics_cube(cube, ['gender'], animal_type='dog').rename(columns={'count': 'Count'})
+    dog_gender_data['animal_type'] = 'dog'
+
+    # Combine the data for both cat and dog
+    combined_data = pd.concat([cat_gender_data, dog_gender_data])
 
-    
-    st.markdown("### Animal Characteristics Analysis")
-    #### plot animal breed in LOS - which top 10 dog/cat breed has a longer LOS
-    dog_data = df[df['animal_type'] == 'dog']
-    cat_data = df[df['animal_type'] == 'cat']
-
-    selected_tab = st.selectbox("Analyse Animal Breed, Gender, Colour: ", ["Top 10 Dog Breed By LOS", 
-                                            "Top 10 Cat Breed By LOS", 
-                                            "Top 10 Adopted Dog Breed",
-                                            "Top 10 Adopted Cat Breed",
-                                            "Gender Analysis",
-                                            "Colour Analysis"])
-
-    if selected_tab == "Top 10 Dog Breed By LOS":
-        # sort the dog breed by average length of stay
-        dog_breed_los = dog_data.groupby(['breed'])['days_in_shelter'].mean().reset_index(name='avg_los')
-        dog_breed_los = dog_breed_los.sort_values(['avg_los'], ascending=False)
-
-        # only show top 10 dog breed
-        dog_breed_los = dog_breed_los.head(10)
-        fig7 = px.bar(dog_breed_los, x='breed', y='avg_los', color='breed')
-        fig7.update_layout(yaxis_title="Average Length of Stay (Days)")
-        st.plotly_chart(fig7)
-    
-    elif selected_tab == "Top 10 Cat Breed By LOS":
+    # Create the stacked bar chart
+    fig12 = px.bar(combined_data, x='animal_type', y='Count', color='gender', barmode='stack', text='Count')
 
-        # sort the cat breed by average length of stay
-        cat_breed_los = cat_data.groupby(['breed'])['days_in_shelter'].mean().reset_index(name='avg_los')
-        cat_breed_los = cat_breed_los.sort_values(['avg_los'], ascending=False)
+    # Update layout to set the title and axis labels
+    fig12.update_layout(title='Stacked Bar Chart of Dog and Cat Gender', xaxis_title='', yaxis_title='Count')
+    return [fig12]
 
-        # only show top 10 cat breed
-        cat_breed_los = cat_breed_los.head(10)
-
-        fig10 = px.bar(cat_breed_los, x='breed', y='avg_los', color='breed')
-        fig10.update_layout(yaxis_title="Average Length of Stay (Days)")
-        st.plotly_chart(fig10)
-    
-    elif selected_tab == "Top 10 Adopted Dog Breed":
-        #### plot animal breed by adoption - which top 10 dog/cat breed has the highest adoption rate
-        dog_breed_adoption = dog_data.groupby(['breed'])['outcome_type'].value_counts().reset_index(name='count')
-        dog_breed_adoption = dog_breed_adoption[dog_breed_adoption['outcome_type'] == 'adoption']
-        dog_breed_adoption = dog_breed_adoption.sort_values(['count'], ascending=False)
-        dog_breed_adoption = dog_breed_adoption.head(10)
-        fig9 = px.bar(dog_breed_adoption, x='breed', y='count', color='breed')
-        fig9.update_layout(yaxis_title="Adoption Count")
-        st.plotly_chart(fig9)
-
-
-    elif selected_tab == "Top 10 Adopted Cat Breed":
-        cat_breed_adoption = cat_data.groupby(['breed'])['outcome_type'].value_counts().reset_index(name='count')
-        cat_breed_adoption = cat_breed_adoption[cat_breed_adoption['outcome_type'] == 'adoption']
-        cat_breed_adoption = cat_breed_adoption.sort_values(['count'], ascending=False)
-        cat_breed_adoption = cat_breed_adoption.head(10)
-        fig11 = px.bar(cat_breed_adoption, x='breed', y='count', color='breed')
-        fig11.update_layout(yaxis_title="Adoption Count")
-        st.plotly_chart(fig11)
-    
-    elif selected_tab =="Gender Analysis":
-        # Group the data by gender and calculate the counts for cat_data
-        cat_gender_data = cat_data['gender'].value_counts().reset_index(name='Count')
-        cat_gender_data.rename(columns={'index': 'gender'}, inplace=True)
-        cat_gender_data['animal_type'] = 'cat'
-
-        # Group the data by gender and calculate the counts for dog_data
-        dog_gender_data = dog_data['gender'].value_counts().reset_index(name='Count')
-        dog_gender_data.rename(columns={'index': 'gender'}, inplace=True)
-        dog_gender_data['animal_type'] = 'dog'
-
-        # Combine the data for both cat and dog
-        combined_data = pd.concat([cat_gender_data, dog_gender_data])
-
-        # Create the stacked bar chart
-        fig12 = px.bar(combined_data, x='animal_type', y='Count', color='gender', barmode='stack', text='Count')
-
-        # Update layout to set the title and axis labels
-        fig12.update_layout(title='Stacked Bar Chart of Dog and Cat Gender', xaxis_title='', yaxis_title='Count')
-        st.plotly_chart(fig12)
-    
-    elif selected_tab == "Colour Analysis":
-        # Group the data by primary_colour and calculate the counts for cat_data
-        cat_colour_data = cat_data['colour'].value_counts().reset_index(name='Count')
-        cat_colour_data = cat_colour_data.sort_values(['Count'], ascending=False)
-        cat_colour_data = cat_colour_data.head(10)
-        cat_colour_data.rename(columns={'index': 'colour'}, inplace=True)
-        cat_colour_data['animal_type'] = 'cat'
+def chart_cat_dog_colour(cube):
+    # Group the data by colour and calculate the counts for cats and dogs
+    cat_colour_data = slice_metrics_cube(cube, ['colour'], animal_type='cat').rename(columns={'count': 'Count'})
+    cat_colour_data = cat_colour_data.sort_values(['Count'], ascending=False)
+    cat_colour_data = cat_colour_data.head(10)
+    cat_colour_data['animal_type'] = 'cat'
 
+    dog_colour_data = slice_metrics_cube(cube, ['colour'], animal_type='dog').rename(columns={'count': 'Count'})
+    dog_colour_data = dog_colour_data.sort_values(['Count'], ascending=False)
+    dog_colour_data = dog_colour_data.head(10)
+    dog_colour_data['animal_type'] = 'dog'
 
-        # Group the data by primary_colour and calculate the counts for dog_data
-        dog_colour_data = dog_data['colour'].value_counts().reset_index(name='Count')
-        dog_colour_data.rename(columns={'index': 'colour'}, inplace=True)
-        dog_colour_data = dog_colour_data.sort_values(['Count'], ascending=False)
-        dog_colour_data = dog_colour_data.head(10)
-        dog_colour_data['animal_type'] = 'dog'
+    fig13 = px.bar(cat_colour_data, x='animal_type', y='Count', color='colour', text='Count',
+                color_discrete_sequence=px.colors.diverging.Picnic)
+    fig13.update_layout(title='Stacked Bar Chart of Cat Colour', xaxis_title = "", yaxis_title='Count')
 
-        # Combine the data for both cat and dog
-        combined_data = pd.concat([cat_colour_data, dog_colour_data])
+    fig13.update_traces(textposition='inside')
 
-        fig13 = px.bar(cat_colour_data, x='animal_type', y='Count', color='colour', text='Count',
-                    color_discrete_sequence=px.colors.diverging.Picnic)
-        fig13.update_layout(title='Stacked Bar Chart of Cat Colour', xaxis_title = "", yaxis_title='Count')
+    fig14 = px.bar(dog_colour_data, x='animal_type', y='Count', color='colour', text='Count',
+                color_discrete_sequence=px.colors.diverging.Picnic)
 
-        fig13.update_traces(textposition='inside')
+    fig14.update_layout(title='Stacked Bar Chart of Dog Colour', xaxis_title = "", yaxis_title='Count')
 
-        fig14 = px.bar(dog_colour_data, x='animal_type', y='Count', color='colour', text='Count',
-                    color_discrete_sequence=px.colors.diverging.Picnic)
+    fig14.update_traces(textposition='inside')
+    return [fig13, fig14]
 
-        fig14.update_layout(title='Stacked Bar Chart of Dog Colour', xaxis_title = "", yaxis_title='Count')
+ADOPTION_CHART_VIEWS = {
+    "Adoption By Year": chart_adoption_by_year,
+    "Adoption By Month": chart_adoption_by_month,
+    "Preferred Day for Adoption": chart_adoption_by_weekday,
+}
 
-        fig14.update_traces(textposition='inside')
+LOS_CHART_VIEWS = {
+    "LOS By Year": chart_los_by_year,
+    "LOS By Month": chart_los_by_month,
+}
 
-        # Show the chart
-        st.plotly_chart(fig13)
-        st.plotly_chart(fig14)
+CHARACTERISTICS_CHART_VIEWS = {
+    "Top 10 Dog Breed By LOS": chart_top_dog_breed_by_los,
+    "Top 10 Cat Breed By LOS": chart_top_cat_breed_by_los,
+    "Top 10 Adopted Dog Breed": chart_top_adopted_dog_breed,
+    "Top 10 Adopted Cat Breed": chart_top_adopted_cat_breed,
+    "Gender Analysis": chart_cat_dog_gender,
+    "Colour Analysis": chart_cat_dog_colour,
+}
 
-    time.sleep(1)
 
+# Model artifacts used for prediction
+MODEL_PATH = os.path.join(ARTIFACT_DIR, 'best_model_os_xgb_clf.joblib')
+SCALER_PATH = os.path.join(ARTIFACT_DIR, 'scaler.joblib')
 
 # Prediction functions
 def adoption_prediction(df):
 
-    df.drop(['outcome_type'], axis=1, inplace=True)
-
-    prediction_data = df.copy()
+    # Work on a copy so the cleaned data in the session keeps the actual outcomes
+    df = df.drop(['outcome_type'], axis=1)
 
-    # intake_condition and intact_status are not present in this dataset
-    prediction_data = prediction_data[['animal_type', 'intake_type', 'is_multicolour', 'is_black', 'is_yellow', 'is_gray', 'age', 'age_group', 'gender', 'days_in_shelter', 'outcome_month', 'outcome_year', 'intake_condition', 'intact_status']]
-
-    # rename the columns
-    prediction_data = prediction_data.rename(columns={
-        'intact_status': 'outcome_intact_status',
-        'age_group': 'outcome_age_group'
-    })
-
-    # restructure the data
-    desired_order = ['animal_type', 'intake_type', 'intake_condition', 'is_multicolour', 'is_black', 'is_yellow', 'is_gray', 'age', 'outcome_age_group', 'gender', 'outcome_intact_status', 'days_in_shelter', 'outcome_month', 'outcome_year']
-
-    new_prediction_data = prediction_data.reindex(columns=desired_order)
-
-    # convert object to category
-    new_prediction_data, categorical_col = convert_object_to_category(new_prediction_data)
-    # label encoding
-    new_prediction_data = label_encoding_categorical_columns(new_prediction_data, categorical_col)
-
-    # feature scaling
-    X_norm_data = feature_scaling(new_prediction_data)
-
-    # load the model and make prediction
-    model = load('best_model_os_xgb_clf.joblib')
-    # prediction = model.predict(X_norm_data)
-
-    # shelter_data['outcome_type'] = prediction
-    # # change 1 to "adoption" and 0 to "not_adoption"
-    # shelter_data['outcome_type'] = shelter_data['outcome_type'].apply(lambda x: 'adoption' if x == 1 else 'not_adoption')
-    
-    # Make binary predictions using predict
-    binary_prediction = model.predict(X_norm_data)
+    new_prediction_data = select_prediction_features(df)
 
-    # Get the adoptability scores using predict_proba
-    prediction_proba = model.predict_proba(X_norm_data)
+    # label encoding with the frozen category vocabulary
+    new_prediction_data = label_encoding_categorical_columns(new_prediction_data, PREDICTION_CATEGORICAL_COLUMNS)
 
-    # Get the probability of each row being classified as "adoption" (class 1)
-    adoptability_scores = prediction_proba[:, 1]
+    # Animals whose encoded features were scored before get their scores from the prediction cache,
+    # only new feature vectors are scaled and sent to the model
+    binary_prediction, adoptability_scores = cached_model_predictions(new_prediction_data)
 
     # Add the binary predictions and adoptability scores to the DataFrame
     df['binary_prediction'] = binary_prediction
     df['adoptability_score'] = adoptability_scores
 
     # Map binary predictions to "adoption" and "not_adoption" for the outcome_type column
-    df['outcome_type'] = df['binary_prediction'].apply(lambda x: 'adoption' if x == 1 else 'not_adoption')
+    df['outcome_type'] = pd.Categorical(np.where(df['binary_prediction'] == 1, 'adoption', 'not_adoption'), categories=['adoption', 'not_adoption'])
 
     # Define the mapping of month numbers to English month names
     month_names = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
 
     # Map the numeric values to their corresponding English month names
-    df['outcome_month_eng'] = df['outcome_month'].map({month: month_names[month - 1] for month in df['outcome_month']})
+    df['outcome_month_eng'] = pd.Categorical.from_codes(df['outcome_month'].to_numpy() - 1, categories=month_names)
 
     # Find the index of the 'outcome_month' column
     outcome_month_idx = df.columns.get_loc('outcome_month')
@@ -802,71 +1912,462 @@ def adoption_prediction(df):
 
     return df
 
-def convert_object_to_category(df):
-    # Create an empty list to store the column names
-    category_columns = []
-    
-    # Iterate through each column in the DataFrame
-    for col in df.columns:
-        if df[col].dtype == 'object':
-            # Convert object columns to category data type
-            df[col] = df[col].astype('category')
-            # Add the column name to the list of category columns
-            category_columns.append(col)
-        elif col in ['outcome_month', 'outcome_year']:
-            # Convert 'outcome_month' and 'outcome_year' columns to category data type
-            df[col] = df[col].astype('category')
-            # Add the column name to the list of category columns
-            category_columns.append(col)
-    
-    # Return the updated DataFrame and the list of category column names
-    return df, category_columns
+# Columns passed to the model, in the order the scaler and model were fitted on
+PREDICTION_FEATURE_COLUMNS = ['animal_type', 'intake_type', 'intake_condition', 'is_multicolour', 'is_black', 'is_yellow', 'is_gray', 'age', 'outcome_age_group', 'gender', 'outcome_intact_status', 'days_in_shelter', 'outcome_month', 'outcome_year']
+PREDICTION_CATEGORICAL_COLUMNS = ['animal_type', 'intake_type', 'intake_condition', 'is_multicolour', 'is_black', 'is_yellow', 'is_gray', 'outcome_age_group', 'gender', 'outcome_intact_status', 'outcome_month', 'outcome_year']
+
+def select_prediction_features(df):
+    # intake_condition and intact_status are not present in this dataset
+    prediction_data = df[['animal_type', 'intake_type', 'is_multicolour', 'is_black', 'is_yellow', 'is_gray', 'age', 'age_group', 'gender', 'days_in_shelter', 'outcome_month', 'outcome_year', 'intake_condition', 'intact_status']]
+
+    # rename the columns
+    prediction_data = prediction_data.rename(columns={
+        'intact_status': 'outcome_intact_status',
+        'age_group': 'outcome_age_group'
+    })
+
+    # restructure the data
+    return prediction_data.reindex(columns=PREDICTION_FEATURE_COLUMNS)
+
+# Frozen category vocabularies, saved beside scaler.joblib so that encoding does not depend on the uploaded batch.
+# Codes follow LabelEncoder (position in the sorted vocabulary), values outside the vocabulary get UNSEEN_CATEGORY_CODE.
+# The scaler was fitted on the codes of the training data, so the codes only line up with the model when the
+# vocabulary is built from the training data. A vocabulary built from other data is marked as not validated and the
+# scores made with it are shown as unvalidated.
+ENCODING_VOCABULARY_PATH = os.path.join(ARTIFACT_DIR, 'encoding_vocabulary.joblib')
+ENCODING_VOCABULARY_VERSION = 3
+UNSEEN_CATEGORY_CODE = -1
+
+def build_encoding_vocabulary(prediction_data, validated=False):
+    vocabulary = {'version': ENCODING_VOCABULARY_VERSION, 'unseen_code': UNSEEN_CATEGORY_CODE, 'validated': validated, 'columns': {}, 'lookup': {}}
+    for col in PREDICTION_CATEGORICAL_COLUMNS:
+        values = prediction_data[col]
+        if pd.api.types.is_bool_dtype(values):
+            values = values.map({True: 'yes', False: 'no'})
+        values = sorted(pd.Series(values, dtype=object).dropna().unique().tolist())
+        vocabulary['columns'][col] = values
+        # value -> code lookup table, precomputed so encoding is a single hash lookup per value
+        vocabulary['lookup'][col] = {value: code for code, value in enumerate(values)}
+    return vocabulary
+
+# Build the vocabulary from a cleaned dataset (the output of transform_data) and save it. Pass validated=True only
+# for the data the model was trained on. The shipped vocabulary is built from testing_sample_data.csv, because the
+# training export is not in the repo, so it is not validated.
+def save_encoding_vocabulary(cleaned_data, path=ENCODING_VOCABULARY_PATH, validated=False):
+    vocabulary = build_encoding_vocabulary(select_prediction_features(cleaned_data), validated)
+    if validated:
+        check_encoding_vocabulary(vocabulary, load_artifact(SCALER_PATH))
+    dump(vocabulary, path)
+    return vocabulary
+
+# Columns whose number of categories differs from the number the scaler was fitted on (its maximum code + 1)
+def encoding_vocabulary_mismatches(vocabulary, scaler):
+    feature_max = dict(zip(scaler.feature_names_in_, scaler.data_max_))
+    return [f'{col} ({len(values)} categories, the scaler expects {int(feature_max[col]) + 1})'
+            for col, values in vocabulary['columns'].items() if len(values) - 1 != feature_max[col]]
+
+# Matching counts do not prove the codes are right, but a validated vocabulary with the wrong counts is certainly wrong
+def check_encoding_vocabulary(vocabulary, scaler):
+    mismatched = encoding_vocabulary_mismatches(vocabulary, scaler)
+    if mismatched:
+        raise ValueError(f"{os.path.basename(ENCODING_VOCABULARY_PATH)} does not match {os.path.basename(SCALER_PATH)}: {', '.join(mismatched)}. "
+                         'Please rebuild it from the training data with save_encoding_vocabulary.')
+
+def load_encoding_vocabulary():
+    vocabulary = load_artifact(ENCODING_VOCABULARY_PATH)
+    if vocabulary.get('version') != ENCODING_VOCABULARY_VERSION:
+        raise ValueError(f"{os.path.basename(ENCODING_VOCABULARY_PATH)} is version {vocabulary.get('version')}, expected version {ENCODING_VOCABULARY_VERSION}. Please rebuild it with save_encoding_vocabulary.")
+    if vocabulary['validated']:
+        check_encoding_vocabulary(vocabulary, load_artifact(SCALER_PATH))
+    return vocabulary
+
+# Warning shown with the scores while the vocabulary is not built from the training data, None once it is
+def get_encoding_vocabulary_warning():
+    vocabulary = load_encoding_vocabulary()
+    if vocabulary['validated']:
+        return None
+    message = ('The adoption predictions are unvalidated: the category codes are not taken from the data the model was trained on, '
+               'so some categories may be scored as other categories.')
+    mismatched = encoding_vocabulary_mismatches(vocabulary, load_artifact(SCALER_PATH))
+    if mismatched:
+        message += f" Categories that differ from the training data: {', '.join(mismatched)}."
+    return message
+
+def encode_with_lookup(values, lookup):
+    # Boolean flags are looked up by the 'yes'/'no' values the vocabulary was built from
+    if pd.api.types.is_bool_dtype(values):
+        values = values.map({True: 'yes', False: 'no'})
+    codes = pd.Series(values, dtype=object).map(lookup)
+    return codes.fillna(UNSEEN_CATEGORY_CODE).astype('int64')
+
+# Years before the first or after the last training year are encoded as that year, instead of UNSEEN_CATEGORY_CODE
+ORDINAL_PREDICTION_COLUMNS = ['outcome_year']
 
 def label_encoding_categorical_columns(df, categorical_col_names):
 
-    # instantiate label encoder
-    lablencoder = LabelEncoder()
+    # encode with the frozen vocabulary instead of refitting a LabelEncoder on every batch
+    vocabulary = load_encoding_vocabulary()
     for col in categorical_col_names:
-        df[col] = lablencoder.fit_transform(df[col])
+        values = df[col]
+        if col in ORDINAL_PREDICTION_COLUMNS:
+            values = values.clip(vocabulary['columns'][col][0], vocabulary['columns'][col][-1])
+        df[col] = encode_with_lookup(values, vocabulary['lookup'][col])
     return df
     
 def feature_scaling(df):
     # load the scaler
-    scaler = load('scaler.joblib')
+    scaler = load_artifact(SCALER_PATH)
     # scale the data
     scaled_data = scaler.transform(df)
     return scaled_data
 
 
-# Plot Prediction functions
-def plot_filtered_data(shelter_data):
-    # Sidebar filters
-    st.sidebar.title("Filters")
-
-    # Sort the unique years in descending order
-    unique_years = pd.Series(np.unique(shelter_data['outcome_year']))
-    unique_years = unique_years.sort_values(ascending=False)
+def model_predictions(prediction_data):
+    # feature scaling
+    X_norm_data = feature_scaling(prediction_data)
 
-    # Add a sidebar filter for the year with "All" as default selection
-    selected_year = st.sidebar.selectbox("Select Year:", ['All'] + unique_years.tolist(), index=0)
+    # load the model and make prediction
+    model = load_artifact(MODEL_PATH)
 
-    # Get unique outcome_month and outcome_month_eng
-    unique_months = shelter_data['outcome_month'].unique()
+    # Make binary predictions using predict
+    binary_prediction = model.predict(X_norm_data)
 
-    # Sort the unique outcome_month in ascending order
-    unique_months = sorted(unique_months)
+    # Get the probability of each row being classified as "adoption" (class 1)
+    adoptability_scores = model.predict_proba(X_norm_data)[:, 1]
+    return binary_prediction, adoptability_scores
+
+# Prediction cache: the prediction and score of every encoded feature vector scored before, for the current
+# model and scaler. Rows are keyed by a 64-bit hash of the encoded feature vector, so an animal whose features
+# did not change since the last upload (or the last rerun) is not scored again, and identical feature vectors
+# in one upload are scored once. Encoding happens before the lookup, so a new vocabulary is taken into account.
+# The cache is saved under .shelter_cache/prediction_cache, one Parquet file per model and scaler, at most every
+# PREDICTION_CACHE_SAVE_SECONDS while scoring and when a scoring job or batch scoring finishes. It keeps the PREDICTION_CACHE_MAX_ROWS most recently
+# used rows, and the files of older models are evicted when the directory goes over PREDICTION_CACHE_MAX_BYTES.
+PREDICTION_CACHE_ENABLED = os.environ.get('SHELTER_PREDICTION_CACHE', '1').lower() not in ('0', 'false', 'no')
+PREDICTION_CACHE_DIR = os.environ.get('SHELTER_PREDICTION_CACHE_DIR', os.path.join(ARTIFACT_DIR, '.shelter_cache', 'prediction_cache'))
+PREDICTION_CACHE_MAX_ROWS = int(os.environ.get('SHELTER_PREDICTION_CACHE_MAX_ROWS', 5_000_000))
+PREDICTION_CACHE_MAX_BYTES = int(os.environ.get('SHELTER_PREDICTION_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+PREDICTION_CACHE_SAVE_SECONDS = 30
+
+_prediction_cache = {'model_key': None, 'table': None, 'dirty': False, 'saved_at': 0.0, 'clock': 0}
+_prediction_cache_lock = threading.Lock()
+_prediction_cache_stats = {'lookups': 0, 'hits': 0, 'evicted': 0}
+
+# Predictions depend on the model and the scaler, the encoding is part of the hashed feature vector
+def prediction_cache_model_key():
+    return hashlib.sha256(f'{get_artifact_hash(MODEL_PATH)}:{get_artifact_hash(SCALER_PATH)}'.encode()).hexdigest()[:24]
+
+def prediction_cache_path(model_key):
+    return os.path.join(PREDICTION_CACHE_DIR, f'{model_key}.parquet')
+
+# One hash per row of the encoded features, taken over the float64 values the scaler receives
+def feature_vector_hashes(prediction_data):
+    return pd.util.hash_pandas_object(prediction_data.astype('float64'), index=False).to_numpy()
+
+# The cache table of a model, indexed by feature hash. Called with the cache lock held.
+def get_prediction_cache_table(model_key):
+    if _prediction_cache['model_key'] != model_key:
+        save_prediction_cache(force=True)
+        table = None
+        if os.path.exists(prediction_cache_path(model_key)):
+            try:
+                table = pd.read_parquet(prediction_cache_path(model_key))
+            except (OSError, ValueError):
+                table = None
+        _prediction_cache.update(model_key=model_key, table=table, dirty=False, saved_at=time.time(),
+                                 clock=0 if table is None else int(table['last_used'].max()))
+    return _prediction_cache['table']
+
+def cached_model_predictions(prediction_data):
+    if not PREDICTION_CACHE_ENABLED:
+        return model_predictions(prediction_data)
+
+    model_key = prediction_cache_model_key()
+    feature_hashes = feature_vector_hashes(prediction_data)
+
+    with _prediction_cache_lock:
+        table = get_prediction_cache_table(model_key)
+        positions = table.index.get_indexer(feature_hashes) if table is not None else np.full(len(feature_hashes), -1)
+        if table is not None:
+            cached_rows = table.iloc[positions[positions >= 0]]
+        _prediction_cache_stats['lookups'] += len(feature_hashes)
+        _prediction_cache_stats['hits'] += int((positions >= 0).sum())
+
+    # Score each new feature vector once
+    missing = positions < 0
+    new_hashes, first_rows = np.unique(feature_hashes[missing], return_index=True)
+    new_binary_prediction, new_scores = (model_predictions(prediction_data[missing].iloc[first_rows]) if len(new_hashes)
+                                         else (np.array([], dtype=np.int64), np.array([], dtype=np.float32)))
+
+    binary_prediction = np.empty(len(feature_hashes), dtype=new_binary_prediction.dtype if table is None else np.result_type(new_binary_prediction.dtype, table['binary_prediction'].dtype))
+    adoptability_scores = np.empty(len(feature_hashes), dtype=new_scores.dtype if table is None else np.result_type(new_scores.dtype, table['adoptability_score'].dtype))
+    if table is not None:
+        binary_prediction[~missing] = cached_rows['binary_prediction'].to_numpy()
+        adoptability_scores[~missing] = cached_rows['adoptability_score'].to_numpy()
+    new_positions = np.searchsorted(new_hashes, feature_hashes[missing])
+    binary_prediction[missing] = new_binary_prediction[new_positions]
+    adoptability_scores[missing] = new_scores[new_positions]
+
+    used_hashes = np.unique(feature_hashes[~missing])
+    new_rows = pd.DataFrame({'binary_prediction': new_binary_prediction, 'adoptability_score': new_scores},
+                            index=pd.Index(new_hashes, name='feature_hash'))
+    update_prediction_cache(model_key, used_hashes, new_rows)
+    return binary_prediction, adoptability_scores
+
+# Mark the rows that were used, add the newly scored rows and evict the least recently used rows
+def update_prediction_cache(model_key, used_hashes, new_rows):
+    with _prediction_cache_lock:
+        table = get_prediction_cache_table(model_key)
+        _prediction_cache['clock'] += 1
+        clock = _prediction_cache['clock']
+
+        if table is not None and len(used_hashes):
+            used_positions = table.index.get_indexer(used_hashes)
+            table.iloc[used_positions[used_positions >= 0], table.columns.get_loc('last_used')] = clock
+        if len(new_rows):
+            new_rows = new_rows.assign(last_used=clock)
+            # Another session may have scored the same feature vectors in the meantime
+            if table is not None:
+                new_rows = new_rows[~new_rows.index.isin(table.index)]
+            table = new_rows if table is None else pd.concat([table, new_rows])
+
+        if table is not None and len(table) > PREDICTION_CACHE_MAX_ROWS:
+            _prediction_cache_stats['evicted'] += len(table) - PREDICTION_CACHE_MAX_ROWS
+            table = table.iloc[np.argsort(-table['last_used'].to_numpy(), kind='stable')[:PREDICTION_CACHE_MAX_ROWS]]
+
+        _prediction_cache['table'] = table
+        _prediction_cache['dirty'] = table is not None
+        save_prediction_cache()
+
+# Write the cache of the current model if it changed, at most every PREDICTION_CACHE_SAVE_SECONDS unless forced.
+# Called with the cache lock held.
+def save_prediction_cache(force=False):
+    if not _prediction_cache['dirty'] or (not force and time.time() - _prediction_cache['saved_at'] < PREDICTION_CACHE_SAVE_SECONDS):
+        return
+    path = prediction_cache_path(_prediction_cache['model_key'])
+    try:
+        os.makedirs(PREDICTION_CACHE_DIR, exist_ok=True)
+        _prediction_cache['table'].to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        evict_cache_dir(PREDICTION_CACHE_DIR, PREDICTION_CACHE_MAX_BYTES)
+    except (OSError, ValueError, TypeError):
+        # The cache is only an optimisation, the scores are simply computed again next time
+        pass
+    _prediction_cache['dirty'] = False
+    _prediction_cache['saved_at'] = time.time()
+
+# Scoring jobs and batch scoring save the cache when they finish
+def flush_prediction_cache():
+    with _prediction_cache_lock:
+        save_prediction_cache(force=True)
+
+# Size and hit rate of the prediction cache, for the sidebar and batch scoring
+def get_prediction_cache_stats():
+    with _prediction_cache_lock:
+        table = _prediction_cache['table']
+        stats = {
+            'cached_feature_vectors': 0 if table is None else len(table),
+            'lookups': _prediction_cache_stats['lookups'],
+            'hits': _prediction_cache_stats['hits'],
+            'hit_rate': round(_prediction_cache_stats['hits'] / _prediction_cache_stats['lookups'], 4) if _prediction_cache_stats['lookups'] else None,
+            'evicted': _prediction_cache_stats['evicted'],
+        }
+    cache_files = os.listdir(PREDICTION_CACHE_DIR) if os.path.isdir(PREDICTION_CACHE_DIR) else []
+    stats['disk_mb'] = round(sum(os.path.getsize(os.path.join(PREDICTION_CACHE_DIR, file_name)) for file_name in cache_files) / 1024 ** 2, 1)
+    return stats
+
+def plot_prediction_cache_stats():
+    with st.sidebar.expander('Prediction Cache'):
+        st.table(pd.DataFrame([get_prediction_cache_stats()]).T.rename(columns={0: 'value'}).astype(str))
+
+
+# Process-wide registry of loaded artifacts, shared by every user session.
+# Each entry keeps the loaded object together with the file hash it was loaded from.
+_artifact_registry = {}
+_artifact_registry_lock = threading.Lock()
+
+def file_hash(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Load a joblib artifact once per process and reuse it until the file changes.
+# The file is only re-hashed when its size or modification time changes, and only reloaded when the hash differs.
+def load_artifact(path):
+    stat = os.stat(path)
+
+    with _artifact_registry_lock:
+        entry = _artifact_registry.get(path)
+        if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+            entry['hits'] += 1
+            return entry['artifact']
+
+        artifact_hash = file_hash(path)
+        if entry is not None and entry['hash'] == artifact_hash:
+            entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+            entry['hits'] += 1
+            return entry['artifact']
+
+        start_time = time.perf_counter()
+        artifact = load(path)
+        _artifact_registry[path] = {
+            'artifact': artifact,
+            'hash': artifact_hash,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'load_seconds': round(time.perf_counter() - start_time, 4),
+            'loads': entry['loads'] + 1 if entry is not None else 1,
+            'hits': 0,
+        }
+        return artifact
+
+# Hash of the artifact file, checked the same way load_artifact checks it
+def get_artifact_hash(path):
+    load_artifact(path)
+    with _artifact_registry_lock:
+        return _artifact_registry[path]['hash']
+
+# Load time, number of loads and cache hits for every artifact in the registry
+def get_artifact_registry_stats():
+    with _artifact_registry_lock:
+        return [{
+            'artifact': os.path.basename(path),
+            'hash': entry['hash'][:12],
+            'load_seconds': entry['load_seconds'],
+            'loads': entry['loads'],
+            'hits': entry['hits'],
+        } for path, entry in _artifact_registry.items()]
+
+
+# Filter index for the prediction page sidebar, built once per scored dataset.
+# For year, month and animal type it keeps the category code of every row and the row positions of every value,
+# and it keeps the row positions sorted by adoptability_score so a score range is found with a binary search.
+FILTER_INDEX_COLUMNS = ['outcome_year', 'outcome_month_eng', 'animal_type']
+
+def build_filter_index(shelter_data):
+    filter_index = {}
+
+    for col in FILTER_INDEX_COLUMNS:
+        codes, uniques = pd.factorize(shelter_data[col])
+        rows_by_code = np.argsort(codes, kind='stable')
+        boundaries = np.searchsorted(codes[rows_by_code], np.arange(len(uniques) + 1))
+        filter_index[col] = {
+            'codes': codes,
+            'value_codes': {value: code for code, value in enumerate(uniques)},
+            'positions': {value: rows_by_code[boundaries[code]:boundaries[code + 1]] for code, value in enumerate(uniques)},
+        }
+
+    scores = shelter_data['adoptability_score'].to_numpy(dtype=np.float64)
+    rows_by_score = np.argsort(scores, kind='stable')
+    filter_index['scores'] = scores
+    filter_index['rows_by_score'] = rows_by_score
+    filter_index['sorted_scores'] = scores[rows_by_score]
+
+    # Options for the sidebar filters
+    filter_index['years'] = sorted(filter_index['outcome_year']['value_codes'], reverse=True)
+    months = shelter_data[['outcome_month', 'outcome_month_eng']].drop_duplicates().sort_values('outcome_month')
+    filter_index['month_names'] = months['outcome_month_eng'].tolist()
+
+    return filter_index
+
+# Row positions (in original order) matching the selected filters, 'All' means no filter on that column.
+# Starts from the smallest candidate set and checks the other filters on those rows only.
+def query_filter_index(filter_index, score_range, selected_values):
+    score_start = np.searchsorted(filter_index['sorted_scores'], score_range[0], side='left')
+    score_end = np.searchsorted(filter_index['sorted_scores'], score_range[1], side='right')
+    candidates = [('adoptability_score', filter_index['rows_by_score'][score_start:score_end])]
+
+    for col, value in selected_values.items():
+        if value != 'All':
+            candidates.append((col, filter_index[col]['positions'].get(value, np.array([], dtype=np.intp))))
+
+    smallest_col, positions = min(candidates, key=lambda candidate: len(candidate[1]))
+
+    for col, _ in candidates:
+        if col == smallest_col:
+            continue
+        if col == 'adoptability_score':
+            scores = filter_index['scores'][positions]
+            positions = positions[(scores >= score_range[0]) & (scores <= score_range[1])]
+        else:
+            value_code = filter_index[col]['value_codes'].get(selected_values[col], -2)
+            positions = positions[filter_index[col]['codes'][positions] == value_code]
+
+    return np.sort(positions)
+
+# Score the cleaned data and build its filter index once, and keep both in the session until the cleaned data changes
+# The scored data and its filter index are kept in the dataset store, so sessions on the same dataset
+# share them. The prediction is keyed by the dataset and the model, and the filter index by the prediction.
+def adoption_prediction_keys(shelter_data):
+    prediction_key = f'{frame_fingerprint(shelter_data)}-prediction-{get_artifact_hash(MODEL_PATH)[:12]}'
+    return prediction_key, f'{prediction_key}-filter-index'
+
+# Score a dataset in chunks of JOB_SCORING_CHUNK_ROWS rows, so the job reports progress and can be cancelled
+def score_dataset_job(job, dataset_key, prediction_key, filter_index_key):
+    shelter_data = get_dataset(dataset_key)
+    if shelter_data is None:
+        raise ValueError('The cleaned dataset is no longer available, please clean it again.')
+
+    scored_chunks = []
+    for first_row in range(0, len(shelter_data), JOB_SCORING_CHUNK_ROWS):
+        report_job_progress(job, 0.9 * first_row / len(shelter_data), f'Scoring records {first_row + 1}-{min(first_row + JOB_SCORING_CHUNK_ROWS, len(shelter_data))} of {len(shelter_data)}')
+        scored_chunks.append(adoption_prediction(shelter_data.iloc[first_row:first_row + JOB_SCORING_CHUNK_ROWS]))
+
+    report_job_progress(job, 0.95, 'Building the filters')
+    flush_prediction_cache()
+    put_dataset(pd.concat(scored_chunks), prediction_key)
+    adoption_prediction_data = get_dataset(prediction_key)
+    put_dataset(build_filter_index(adoption_prediction_data), filter_index_key)
+    return prediction_key
+
+# The scored data and filter index of the session's dataset. Until they are ready a scoring job runs in the
+# background and (None, None) is returned while the page shows its progress.
+def get_adoption_prediction(shelter_data):
+    prediction_key, filter_index_key = adoption_prediction_keys(shelter_data)
+    adoption_prediction_data = get_dataset(prediction_key)
+    filter_index = get_dataset(filter_index_key)
+    if adoption_prediction_data is not None and filter_index is not None:
+        return adoption_prediction_data, filter_index
+
+    # A cancelled or failed scoring job is only started again when the user asks for it
+    stopped_scoring = st.session_state.get('stopped_scoring_job')
+    if stopped_scoring is not None and stopped_scoring['key'] == prediction_key:
+        st.warning(stopped_scoring['message'])
+        if not st.button('Score the data again'):
+            return None, None
+        st.session_state.pop('stopped_scoring_job')
+
+    # Start scoring, unless this dataset is already being scored for the session
+    if st.session_state.get('scoring_job_key') != prediction_key or get_job_status(st.session_state.get('scoring_job_id')) is None:
+        st.session_state['scoring_job_id'] = submit_job('scoring', score_dataset_job, put_dataset(shelter_data), prediction_key, filter_index_key)
+        st.session_state['scoring_job_key'] = prediction_key
+
+    job = poll_session_job('scoring_job_id', 'Scoring')
+    if job is None:
+        return None, None
+    if job['status'] != 'done':
+        message = 'Scoring was cancelled.' if job['status'] == 'cancelled' else f"Scoring failed: {job['error']}"
+        st.session_state['stopped_scoring_job'] = {'key': prediction_key, 'message': message}
+        st.experimental_rerun()
+
+    pop_job_result(job['id'])
+    return get_dataset(prediction_key), get_dataset(filter_index_key)
 
-    # Create a dictionary to map outcome_month to outcome_month_eng
-    month_names_map = dict(shelter_data[['outcome_month', 'outcome_month_eng']].values)
+# Plot Prediction functions
+def plot_filtered_data(shelter_data, filter_index=None):
+    if filter_index is None:
+        filter_index = build_filter_index(shelter_data)
 
-    # Map the sorted outcome_month to their corresponding outcome_month_eng
-    sorted_month_names = [month_names_map[month] for month in unique_months]
+    # Sidebar filters
+    st.sidebar.title("Filters")
 
-    # Add a "All" option to the beginning of the list
-    sorted_month_names.insert(0, "All")
+    # Add a sidebar filter for the year with "All" as default selection, years in descending order
+    selected_year = st.sidebar.selectbox("Select Year:", ['All'] + filter_index['years'], index=0)
 
-    # Add a sidebar filter for the month with "All" as default selection
-    selected_month = st.sidebar.selectbox("Select Month:", sorted_month_names, index=0)
+    # Add a sidebar filter for the month with "All" as default selection, months in calendar order
+    selected_month = st.sidebar.selectbox("Select Month:", ['All'] + filter_index['month_names'], index=0)
 
      # Add a sidebar filter for Animal Type with "All" as default selection
     selected_animal_type = st.sidebar.selectbox("Select Animal Type:", ['All', 'cat', 'dog'], index=0)
@@ -874,30 +2375,31 @@ def plot_filtered_data(shelter_data):
     selected_adoptability_score = st.sidebar.slider("Select Adoptability Score: ", 0.0, 1.0, (0.5, 1.0))
 
     # Filter the results based on the selected filters
-    filtered_results = shelter_data[
-        (shelter_data['adoptability_score'] >= selected_adoptability_score[0]) &
-        (shelter_data['adoptability_score'] <= selected_adoptability_score[1]) &
-        (shelter_data['outcome_year'] == selected_year if selected_year != 'All' else True) &
-        (shelter_data['outcome_month_eng'] == selected_month if selected_month != 'All' else True) &
-        # (shelter_data['breed'] == selected_breeds if selected_breeds != 'All' else True) &
-        (shelter_data['animal_type'] == selected_animal_type if selected_animal_type != 'All' else True)
-    ]
+    positions = query_filter_index(filter_index, selected_adoptability_score, {
+        'outcome_year': selected_year,
+        'outcome_month_eng': selected_month,
+        'animal_type': selected_animal_type,
+    })
+    filtered_results = shelter_data.iloc[positions]
 
-    # # Display the filtered results, and use them to create graphs and visualizations
-    # st.write(filtered_results)
+    # Charts are reused while the scored data and the filters stay the same
+    filter_key = (selected_year, selected_month, selected_animal_type, selected_adoptability_score)
 
     # Plot the filtered data
-    plot_graphs_animal_prediction(filtered_results)
+    plot_graphs_animal_prediction(filtered_results, frame_fingerprint(shelter_data), filter_key)
 
-def plot_graphs_animal_prediction(shelter_data):
+def plot_graphs_animal_prediction(shelter_data, dataset_key=None, filter_key=None):
 
     # calculating and plot the adoption rate for cats and dogs in a bar chart
-    plot_cat_dog_adoption_rate(shelter_data)
-    plot_cat_dog_breed_colour(shelter_data)
+    plot_cat_dog_adoption_rate(shelter_data, dataset_key, filter_key)
+    plot_cat_dog_breed_colour(shelter_data, dataset_key, filter_key)
 
-def plot_cat_dog_adoption_rate(shelter_data):
+def plot_cat_dog_adoption_rate(shelter_data, dataset_key=None, filter_key=None):
 
     st.markdown("#### Cats and Dogs Predicted Adoption Rate")
+    plot_chart_section({'Predicted Adoption Rate': chart_cat_dog_adoption_rate}, shelter_data, dataset_key, filter_key)
+
+def chart_cat_dog_adoption_rate(shelter_data):
     # Filter the data for cats and dogs separately
     cat_data = shelter_data[shelter_data['animal_type'] == 'cat']
     dog_data = shelter_data[shelter_data['animal_type'] == 'dog']
@@ -941,22 +2443,78 @@ def plot_cat_dog_adoption_rate(shelter_data):
         bargap=0.1
     )
 
-    # Show the chart
-    st.plotly_chart(fig)
+    return [fig]
 
-def plot_cat_dog_breed_colour(shelter_data):
+# Above this many rows the age histogram, age vs length of stay scatter and length of stay box plot
+# are built from server-side aggregates, set SHELTER_LARGE_CHART_ROWS to change it
+LARGE_CHART_ROW_THRESHOLD = int(os.environ.get('SHELTER_LARGE_CHART_ROWS', 50_000))
+AGE_HISTOGRAM_BIN_YEARS = 1
 
-    custom_color_scheme = ['#51EAEA', '#2D31FA', '#47B5FF', '#59C1BD', '#A0E4CB', '#CFF5E7', '#00FFDD']
-    purple =['#590696', '#3120E0', '#6C00FF','#6C4AB6', '#8D72E1', '#AA77FF', '#D4ADFC']
+def get_chart_render_mode(num_rows, threshold=None):
+    threshold = LARGE_CHART_ROW_THRESHOLD if threshold is None else threshold
+    return 'binned' if num_rows > threshold else 'full'
 
+def chart_render_mode_caption(render_mode, num_rows):
+    if render_mode == 'binned':
+        st.caption(f'{num_rows:,} rows is above the {LARGE_CHART_ROW_THRESHOLD:,} row limit, so the histogram, scatter and box plots are drawn from '
+                   f'server-side bins and quartile summaries (box plot outliers are not shown).')
+    else:
+        st.caption(f'All {num_rows:,} rows are drawn.')
+
+# Number of animals per gender and age bin
+def binned_age_by_gender(shelter_data):
+    age_bin = (shelter_data['age'] // AGE_HISTOGRAM_BIN_YEARS) * AGE_HISTOGRAM_BIN_YEARS
+    binned = shelter_data.groupby([shelter_data['gender'], age_bin.rename('age')], observed=True).size().reset_index(name='count')
+    # Put each bin's total in the middle of the bin
+    binned['age'] = binned['age'] + AGE_HISTOGRAM_BIN_YEARS / 2
+    return plain_categories(binned)
+
+# Collapse rows with the same values into one point with a count, overlapping points look the same on a scatter plot
+def distinct_points(shelter_data, columns):
+    return plain_categories(shelter_data.groupby(columns, observed=True).size().reset_index(name='count'))
+
+# Horizontal box plot drawn from precomputed quartiles and whiskers, one box per (y, color) group
+def summary_box_plot(shelter_data, y, x, color):
+    grouped = shelter_data.groupby([color, y], observed=True)[x]
+    summary = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    summary.columns = ['q1', 'median', 'q3']
+
+    # Whiskers end at the furthest value within 1.5 IQR of the box
+    iqr = summary['q3'] - summary['q1']
+    limits = pd.DataFrame({'low': summary['q1'] - 1.5 * iqr, 'high': summary['q3'] + 1.5 * iqr})
+    values = shelter_data[[color, y, x]].join(limits, on=[color, y])
+    summary['lowerfence'] = values[x].where(values[x] >= values['low']).groupby([values[color], values[y]], observed=True).min()
+    summary['upperfence'] = values[x].where(values[x] <= values['high']).groupby([values[color], values[y]], observed=True).max()
+    summary = plain_categories(summary.reset_index())
+
+    fig = go.Figure()
+    for trace_num, (color_value, group) in enumerate(summary.groupby(color, sort=False)):
+        fig.add_trace(go.Box(
+            name=color_value, y=group[y], q1=group['q1'], median=group['median'], q3=group['q3'],
+            lowerfence=group['lowerfence'], upperfence=group['upperfence'], orientation='h',
+            marker_color=px.colors.qualitative.Plotly[trace_num % len(px.colors.qualitative.Plotly)],
+        ))
+    fig.update_layout(boxmode='group')
+    return fig
+
+def plot_cat_dog_breed_colour(shelter_data, dataset_key=None, filter_key=None):
 
     # plot breed and colour
     st.markdown("#### Animal Breed and Gender Analysis")
 
+    selected_view = plot_chart_section(BREED_GENDER_CHART_VIEWS, shelter_data, dataset_key, filter_key, label='Animal Breed and Gender Analysis')
+    if selected_view != "Breed Analysis":
+        chart_render_mode_caption(get_chart_render_mode(len(shelter_data)), len(shelter_data))
+
+CUSTOM_COLOR_SCHEME = ['#51EAEA', '#2D31FA', '#47B5FF', '#59C1BD', '#A0E4CB', '#CFF5E7', '#00FFDD']
+PURPLE = ['#590696', '#3120E0', '#6C00FF','#6C4AB6', '#8D72E1', '#AA77FF', '#D4ADFC']
+
+# Prediction page chart builders, each takes the filtered prediction data and returns its figures
+def chart_breed_analysis(shelter_data):
     animal_breed = shelter_data['breed'].value_counts().head(10)
 
     fig1 = px.bar(animal_breed, title='Breed Bar Chart', x = animal_breed.index, y = animal_breed.values, color=animal_breed.values,
-                    color_continuous_scale=custom_color_scheme, labels={'x': 'Animal Breed', 'y': 'Count'})
+                    color_continuous_scale=CUSTOM_COLOR_SCHEME, labels={'x': 'Animal Breed', 'y': 'Count'})
     fig1.update_layout(showlegend=False)
 
     # plot cat breed
@@ -967,11 +2525,11 @@ def plot_cat_dog_breed_colour(shelter_data):
     fig2.update_layout(showlegend=False)
 
     mixed_breed = shelter_data['is_mix_breed'].value_counts()
-    x = mixed_breed.index.tolist()
+    x = yes_no(mixed_breed.index).tolist()
     y = mixed_breed.values.tolist()
 
     fig3 = go.Figure(data=[go.Pie(labels=x, values = y, hole=0.45,
-                                    marker_colors=purple,
+                                    marker_colors=PURPLE,
                                     textinfo='label+percent')])
     # add chart title
     fig3.update_layout(title_text='Is Animal Mixed Breed?')
@@ -988,6 +2546,7 @@ def plot_cat_dog_breed_colour(shelter_data):
 
     # Melt the DataFrame to convert the columns to rows for plotting
     counts_melted = pd.melt(counts_df, id_vars=['count'], value_vars=['is_multicolour', 'is_black', 'is_white', 'is_brown', 'is_yellow', 'is_gray'])
+    counts_melted['value'] = yes_no(counts_melted['value'].astype(bool))
 
     # Create the stacked bar chart
     fig4 = px.bar(counts_melted, x='variable', y='count', color='value', barmode='stack', labels={'variable': 'Color', 'count': 'Count'},
@@ -1008,14 +2567,16 @@ def plot_cat_dog_breed_colour(shelter_data):
         # Add a gap between the bars
         bargap=0.1
     )
+    return [fig1, fig2, fig3, fig4]
 
+def chart_gender_analysis(shelter_data):
     # gender by outcome_intact_status
     # animal_gender_intact_counts = shelter_data[['gender', 'outcome_intact_status']].value_counts()
 
     # counts_df = animal_gender_intact_counts.reset_index()
 
     # Get the counts of each combination of gender and outcome_intact_status
-    animal_gender = shelter_data[['gender', 'intact_status']].value_counts().reset_index(name='count')
+    animal_gender = plain_categories(shelter_data[['gender', 'intact_status']].value_counts().reset_index(name='count'))
 
     # Create the stacked bar chart
     fig5 = px.bar(animal_gender, x='gender', y='count', color='intact_status', barmode='stack',
@@ -1037,8 +2598,20 @@ def plot_cat_dog_breed_colour(shelter_data):
         bargap=0.1
     )
 
+    # Large datasets are drawn from server-side aggregates instead of sending every row to the browser
+    render_mode = get_chart_render_mode(len(shelter_data))
+
     # Plot histogram for age by gender male and female
-    fig6 = px.histogram(shelter_data, title="Histogram Age by Gender",x="age", color="gender")
+    if render_mode == 'binned':
+        fig6 = px.histogram(binned_age_by_gender(shelter_data), title="Histogram Age by Gender", x="age", y="count", color="gender", histfunc='sum')
+        fig6.update_traces(xbins=dict(start=0, size=AGE_HISTOGRAM_BIN_YEARS))
+        fig6.update_yaxes(title_text='count')
+    else:
+        fig6 = px.histogram(plain_categories(shelter_data[['age', 'gender']]), title="Histogram Age by Gender",x="age", color="gender")
+    return [fig5, fig6]
+
+def chart_age_los_analysis(shelter_data):
+    render_mode = get_chart_render_mode(len(shelter_data))
 
     age_group_count = shelter_data['age_group'].value_counts()
 
@@ -1048,16 +2621,22 @@ def plot_cat_dog_breed_colour(shelter_data):
 
     # Create the bar chart
     fig7 = px.bar(age_group_df, x='Age Group', y='Count', color='Count',
-                color_continuous_scale=purple, labels={'x': 'Age Group', 'y': 'Count'},
+                color_continuous_scale=PURPLE, labels={'x': 'Age Group', 'y': 'Count'},
                 title='Age Group Bar Chart')
     
     # Define the custom color map for 'outcome_type'
     color_map = {'not_adoption': '#F11A7B', 'adoption': '#2FA4FF'}#2FA4FF
 
     # Create the scatter plot
-    fig8 = px.scatter(shelter_data, x="age", y="days_in_shelter", color="outcome_type",
-                    color_discrete_map=color_map,
-                    title="Scatter Plot of Age and Length of Stay")
+    if render_mode == 'binned':
+        # One WebGL point per distinct (age, length of stay, outcome), with the number of animals in the hover text
+        fig8 = px.scatter(distinct_points(shelter_data, ['age', 'days_in_shelter', 'outcome_type']), x="age", y="days_in_shelter", color="outcome_type",
+                        color_discrete_map=color_map, hover_data=['count'], render_mode='webgl',
+                        title="Scatter Plot of Age and Length of Stay")
+    else:
+        fig8 = px.scatter(plain_categories(shelter_data[['age', 'days_in_shelter', 'outcome_type']]), x="age", y="days_in_shelter", color="outcome_type",
+                        color_discrete_map=color_map,
+                        title="Scatter Plot of Age and Length of Stay")
     
     # edit y axis title
     fig8.update_yaxes(title_text='Length of Stay (Days)')
@@ -1065,10 +2644,14 @@ def plot_cat_dog_breed_colour(shelter_data):
 
 
     # plot the box plot by each intake type
-    fig9 = px.box(shelter_data, y="intake_type", x="days_in_shelter", color="outcome_type",
-                labels={'intake_type': 'Intake Type', 'days_in_shelter': 'Length of Stay (Days)'},
-                title="Box Plot of Length of Stay by Intake Type")
-    fig9.update_traces(quartilemethod="exclusive")
+    if render_mode == 'binned':
+        fig9 = summary_box_plot(shelter_data, y='intake_type', x='days_in_shelter', color='outcome_type')
+        fig9.update_layout(title_text="Box Plot of Length of Stay by Intake Type")
+    else:
+        fig9 = px.box(plain_categories(shelter_data[['intake_type', 'days_in_shelter', 'outcome_type']]), y="intake_type", x="days_in_shelter", color="outcome_type",
+                    labels={'intake_type': 'Intake Type', 'days_in_shelter': 'Length of Stay (Days)'},
+                    title="Box Plot of Length of Stay by Intake Type")
+        fig9.update_traces(quartilemethod="exclusive")
     # Customize the layout of the box plot
     fig9.update_layout(
         xaxis_title='Length of Stay (Days)',
@@ -1086,7 +2669,7 @@ def plot_cat_dog_breed_colour(shelter_data):
     # plot average length of stay by breed to show the top 10 breeds
 
     # Get the average length of stay for each breed
-    breed_los = shelter_data.groupby('breed')['days_in_shelter'].mean().reset_index(name='avg_los')
+    breed_los = shelter_data.groupby('breed', observed=True)['days_in_shelter'].mean().reset_index(name='avg_los')
 
     # Sort the breeds by their average length of stay
     breed_los = breed_los.sort_values(by='avg_los', ascending=False)
@@ -1107,29 +2690,53 @@ def plot_cat_dog_breed_colour(shelter_data):
     )
 
 
-    # plot the graphs in tabs
-    tab1, tab2, tab3 = st.tabs(["Breed Analysis", "Gender Analysis", "Age and LOS Analysis"])
-    with tab1:
-        st.plotly_chart(fig1)
-        st.plotly_chart(fig2)
-        st.plotly_chart(fig3)
-        st.plotly_chart(fig4)
+    return [fig7, fig8, fig9, fig10]
+
+BREED_GENDER_CHART_VIEWS = {
+    "Breed Analysis": chart_breed_analysis,
+    "Gender Analysis": chart_gender_analysis,
+    "Age and LOS Analysis": chart_age_los_analysis,
+}
 
-    with tab2:
-        st.plotly_chart(fig5)
-        st.plotly_chart(fig6)
 
-    with tab3:
-        st.plotly_chart(fig7)
-        st.plotly_chart(fig8)
-        st.plotly_chart(fig9)
-        st.plotly_chart(fig10)
+_sample_dataset = None
+_sample_dataset_lock = threading.Lock()
 
+# Load the sample dataset once per process, keeping both the parsed frame and the raw CSV bytes
+# that the download button serves, so reruns neither read nor re-serialize the file
+def get_sample_dataset():
+    global _sample_dataset
 
+    with _sample_dataset_lock:
+        if _sample_dataset is None:
+            source = SAMPLE_DATASET_PATH
+            if SAMPLE_DATASET_URL:
+                try:
+                    with urllib.request.urlopen(SAMPLE_DATASET_URL, timeout=10) as response:
+                        csv_bytes = response.read()
+                    source = SAMPLE_DATASET_URL
+                except OSError as e:
+                    logging.getLogger(__name__).warning('Could not download the sample dataset (%s), using the bundled copy', e)
 
+            if source == SAMPLE_DATASET_PATH:
+                with open(SAMPLE_DATASET_PATH, 'rb') as f:
+                    csv_bytes = f.read()
 
-# Function to load dataset from GitHub repository
+            _sample_dataset = {
+                'data': pd.read_csv(io.BytesIO(csv_bytes)),
+                'download_bytes': csv_bytes,
+                'source': source,
+            }
+        return _sample_dataset
+
+# Function to load the sample dataset, the frame is shared across sessions so treat it as read-only
 def load_dataset_from_repo():
-    testing_data_url = 'https://raw.githubusercontent.com/ZhiYing1112/fyp-animal-shelter-analytics-dashboard/main/testing_sample_data.csv'
-    df = pd.read_csv(testing_data_url)
-    return df
+    return get_sample_dataset()['data']
+
+def get_sample_dataset_download():
+    return get_sample_dataset()['download_bytes']
+
+
+# Opt-in profiling of every public function above, see profiling.py
+if profiling.PROFILING_ENABLED:
+    profiling.instrument_module(globals())
@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
 import data_functions as dip
+import profiling
 import base64
 
 st.set_page_config(
@@ -10,6 +11,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Profile this rerun when SHELTER_PROFILE is set
+profiling.start_rerun()
+
 
 # This part is about the file upload and data preprocessing part
 st.title('Getting Started 🐾')
@@ -22,7 +26,7 @@ sample_dataset = dip.load_dataset_from_repo()
 st.sidebar.markdown("### Sample Dataset:")
 st.sidebar.write("Try out this app with the sample dataset 👇")
 if sample_dataset is not None:
-    csv = sample_dataset.to_csv(index=False)
+    csv = dip.get_sample_dataset_download()
     if st.sidebar.download_button("Download Sample Dataset", data=csv, key="download", help="Click to download the sample dataset.", file_name="sample_dataset.csv" ):
         st.sidebar.success('File downloaded successfully.')
 
@@ -59,11 +63,20 @@ if uploaded_data is not None:
     st.write('Column names: ', ', '.join(uploaded_data.columns))
     st.subheader('Data Preprocessing')
 
+    # A newer export can be appended to the dataset that was already cleaned instead of replacing it
+    upload_mode = 'Replace the current dataset'
+    if dip.get_cleaned_data() is not None:
+        upload_mode = st.radio('This file should', ['Replace the current dataset', 'Append to the current dataset'], horizontal=True,
+                               help='Appending cleans only the new records. Records with the same animal_id and intake date replace the existing ones.')
+
+    # Cleaning runs in the background, the page shows its progress until the cleaned data is ready
     if st.button('Click to clean the data'):
-        cleaned_data = dip.data_preprocessing(uploaded_data)
+        dip.start_cleaning_job(uploaded_data, append=upload_mode == 'Append to the current dataset')
+
+    cleaned_data = dip.plot_cleaning_job()
+    if cleaned_data is not None:
         st.dataframe(cleaned_data.head(5))
         st.success('Data cleaning completed! 🎉')
         st.markdown('<p style="color:#2FA4FF;font-size:20px;">Navigate yourself to the dashboard to view data insights ✨📊</p>', unsafe_allow_html=True)
-        st.session_state['cleaned_data'] = cleaned_data
 
-    
\ No newline at end of file
+profiling.plot_profiling_panel()
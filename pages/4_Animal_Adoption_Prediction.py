@@ -2,6 +2,7 @@ import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
 import data_functions as dip
+import profiling
 
 st.set_page_config(
     page_title="Animal Adoption Prediction",
@@ -10,11 +11,15 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Profile this rerun when SHELTER_PROFILE is set
+profiling.start_rerun()
+
 st.title('Animal Adoption Prediction 🤖')
 
 
 def main_function():
-    if st.session_state.get('cleaned_data') is not None:
+    shelter_data = dip.get_cleaned_data()
+    if shelter_data is not None:
            
         st.info('''
         Note:         
@@ -22,18 +27,31 @@ def main_function():
         Your uploaded data is predicted and the results are shown below. 😀
 
         ''')
-        shelter_data = st.session_state.get('cleaned_data')
+        # Scoring runs in the background, the page shows its progress until the scored data is ready
+        adoption_prediction_data, filter_index = dip.get_adoption_prediction(shelter_data)
+        if adoption_prediction_data is None:
+            return
 
-        adoption_prediction_data = dip.adoption_prediction(shelter_data)
+        # The scores are unvalidated until the encoding vocabulary is rebuilt from the training data
+        encoding_warning = dip.get_encoding_vocabulary_warning()
+        if encoding_warning:
+            st.warning(encoding_warning)
 
         # Populate the dashboard with metrices and graphs
         total_num_intakes = st.session_state.get('total_num_intakes')
         total_num_adoptions = st.session_state.get('total_num_adoptions')
         save_rate = st.session_state.get('save_rate')
         live_release_rate = st.session_state.get('live_release_rate')
+        kpi_accumulator = st.session_state.get('kpi_accumulator')
+
+        dip.card_metrics(total_num_intakes, total_num_adoptions, save_rate, live_release_rate, dip.kpi_trend(kpi_accumulator))
+        dip.plot_filtered_data(adoption_prediction_data, filter_index)
 
-        dip.card_metrics(total_num_intakes, total_num_adoptions, save_rate, live_release_rate)
-        dip.plot_filtered_data(adoption_prediction_data)
+        # Show whether the model and scaler are being reused across reruns
+        with st.sidebar.expander('Model Cache'):
+            st.table(dip.get_artifact_registry_stats())
+        dip.plot_prediction_cache_stats()
+        dip.plot_dataset_store_stats()
 
         # # export the data to csv
         # adoption_prediction_data.to_csv('adoption_prediction_data.csv', index=False)
@@ -42,4 +60,6 @@ def main_function():
         
 
 
-main_function()
\ No newline at end of file
+main_function()
+
+profiling.plot_profiling_panel()
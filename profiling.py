@@ -0,0 +1,184 @@
+# Opt-in profiling of the data functions, enabled by setting SHELTER_PROFILE=1 before launching Streamlit
+# (or running batch_scoring.py / benchmark_pipeline.py).
+# Every public function of data_functions is wrapped to record its call count, cumulative and per-call
+# latency and the number of rows it processed. Timings include the functions called inside.
+# When the process exits a JSON summary and a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)
+# are written to SHELTER_PROFILE_DIR, and pages can show the breakdown of the current rerun in the sidebar.
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+PROFILING_ENABLED = os.environ.get('SHELTER_PROFILE', '').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.environ.get('SHELTER_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.shelter_cache', 'profile'))
+
+# Latest calls kept for the Chrome trace and the rerun breakdown, older calls only count towards the totals
+MAX_TRACE_EVENTS = 200_000
+
+_function_stats = {}
+_trace_events = deque(maxlen=MAX_TRACE_EVENTS)
+_profile_lock = threading.Lock()
+_start_time = time.perf_counter()
+
+
+_job_context = threading.local()
+
+# Calls are tagged with the browser session they ran for, so each session sees only its own reruns.
+# Background job threads have no script context, they run with the session that submitted the job.
+def get_session_id():
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        return ctx.session_id
+    return getattr(_job_context, 'session_id', None)
+
+def get_job_kind():
+    return getattr(_job_context, 'job_kind', None)
+
+# Run a background job's calls as calls of the session that submitted it
+@contextmanager
+def job_session(session_id, job_kind):
+    _job_context.session_id, _job_context.job_kind = session_id, job_kind
+    try:
+        yield
+    finally:
+        _job_context.session_id, _job_context.job_kind = None, None
+
+# Rows of the first frame passed in, or of the frame returned
+def count_rows(args, result):
+    for value in args + (result[0] if isinstance(result, tuple) and result else result,):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return len(value)
+    return 0
+
+def record_call(name, start, seconds, rows):
+    with _profile_lock:
+        stats = _function_stats.get(name)
+        if stats is None:
+            stats = _function_stats[name] = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'rows': 0}
+        stats['calls'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['rows'] += rows
+
+        _trace_events.append({
+            'name': name,
+            'start': start,
+            'seconds': seconds,
+            'rows': rows,
+            'thread': threading.get_ident(),
+            'session': get_session_id(),
+            'job': get_job_kind(),
+        })
+
+def profile_function(function):
+    @functools.wraps(function)
+    def profiled(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException:
+            record_call(function.__name__, start, time.perf_counter() - start, 0)
+            raise
+        record_call(function.__name__, start, time.perf_counter() - start, count_rows(args, result))
+        return result
+    return profiled
+
+# Wrap the public functions defined in a module, given its globals(). Calls between the module's own
+# functions look the names up in the globals, so they go through the wrappers as well.
+def instrument_module(module_globals):
+    module_name = module_globals['__name__']
+    for name, value in list(module_globals.items()):
+        if callable(value) and not isinstance(value, type) and not name.startswith('_') and getattr(value, '__module__', None) == module_name:
+            module_globals[name] = profile_function(value)
+
+    # Functions that were stored in dicts (e.g. chart views) before being wrapped
+    for value in module_globals.values():
+        if isinstance(value, dict):
+            for key, function in list(value.items()):
+                if callable(function) and getattr(function, '__module__', None) == module_name and not hasattr(function, '__wrapped__'):
+                    value[key] = module_globals.get(function.__name__, function)
+
+    atexit.register(dump_profile)
+
+def summarize(events=None):
+    if events is None:
+        with _profile_lock:
+            stats = {name: dict(entry) for name, entry in _function_stats.items()}
+    else:
+        stats = {}
+        for event in events:
+            entry = stats.setdefault(event['name'], {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+            entry['calls'] += 1
+            entry['total_seconds'] += event['seconds']
+            entry['max_seconds'] = max(entry['max_seconds'], event['seconds'])
+            entry['rows'] += event['rows']
+
+    summary = [{
+        'function': name,
+        'calls': entry['calls'],
+        'total_ms': round(entry['total_seconds'] * 1000, 2),
+        'mean_ms': round(entry['total_seconds'] * 1000 / entry['calls'], 3),
+        'max_ms': round(entry['max_seconds'] * 1000, 2),
+        'rows': entry['rows'],
+    } for name, entry in stats.items()]
+    return sorted(summary, key=lambda row: row['total_ms'], reverse=True)
+
+# Chrome trace format: one complete ("X") event per call, in microseconds since the process started
+def chrome_trace(events):
+    return {'traceEvents': [{
+        'name': event['name'],
+        'ph': 'X',
+        'ts': round((event['start'] - _start_time) * 1e6, 1),
+        'dur': round(event['seconds'] * 1e6, 1),
+        'pid': os.getpid(),
+        'tid': event['thread'],
+        'args': {'rows': event['rows']},
+    } for event in events]}
+
+def dump_profile(profile_dir=None):
+    profile_dir = profile_dir or PROFILE_DIR
+    with _profile_lock:
+        events = list(_trace_events)
+    if not events:
+        return None
+
+    os.makedirs(profile_dir, exist_ok=True)
+    summary_path = os.path.join(profile_dir, f'profile_summary_{os.getpid()}.json')
+    trace_path = os.path.join(profile_dir, f'profile_trace_{os.getpid()}.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summarize(), f, indent=2)
+    with open(trace_path, 'w') as f:
+        json.dump(chrome_trace(events), f)
+    return summary_path, trace_path
+
+# Pages call start_rerun() at the top and plot_profiling_panel() at the bottom
+def start_rerun():
+    if PROFILING_ENABLED:
+        st.session_state['profiling_rerun_start'] = time.perf_counter()
+
+def plot_profiling_panel():
+    if not PROFILING_ENABLED:
+        return
+
+    rerun_start = st.session_state.get('profiling_rerun_start', _start_time)
+    session_id = get_session_id()
+    with _profile_lock:
+        events = [event for event in _trace_events if event['start'] >= rerun_start and event['session'] == session_id and event['job'] is None]
+        job_events = [event for event in _trace_events if event['session'] == session_id and event['job'] is not None]
+
+    with st.sidebar.expander('Profiling'):
+        st.write(f'This rerun: {len(events)} profiled calls')
+        st.dataframe(pd.DataFrame(summarize(events)), hide_index=True)
+        if job_events:
+            st.write(f'Background jobs of this session: {len(job_events)} profiled calls')
+            st.dataframe(pd.DataFrame(summarize(job_events)), hide_index=True)
+        st.download_button('Download Chrome trace', data=json.dumps(chrome_trace(events + job_events)),
+                           file_name='shelter_profile_trace.json', mime='application/json')
@@ -0,0 +1,99 @@
+# Seeded generator of synthetic shelter records, used to benchmark the pipeline beyond the bundled sample.
+# Every record takes its animal profile (type, intake and outcome type, condition, gender, age, breed, colour)
+# from a random row of testing_sample_data.csv, so the value formats and the mix of values match a real export
+# ("16 years", "Spayed Female", "Domestic Shorthair Mix", "Brown/White").
+# Intake dates are spread over several years and each outcome date is the intake date plus a length of stay
+# taken from the sample. Dates are written day first, like the sample ("27/4/2023 14:44").
+# A share of the records are repeat intakes of an animal seen earlier in the same chunk.
+#
+# Usage: python shelter_data_generator.py 1000000 synthetic_1m.csv --seed 42
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_functions as dip
+
+PROFILE_COLUMNS = ['intake_type', 'intake_condition', 'animal_type', 'outcome_type', 'gender', 'age', 'breed', 'colour']
+OUTPUT_COLUMNS = ['animal_id', 'intake_date_time', 'intake_type', 'intake_condition', 'animal_type',
+                  'outcome_date_time', 'outcome_type', 'gender', 'age', 'breed', 'colour']
+
+INTAKE_START = pd.Timestamp('2013-10-01')
+INTAKE_END = pd.Timestamp('2023-06-01')
+REPEAT_INTAKE_RATE = 0.05
+CHUNK_ROWS = 1_000_000
+
+_sample_profiles = None
+
+# Animal profiles and lengths of stay of the bundled sample, loaded once
+def load_sample_profiles():
+    global _sample_profiles
+
+    if _sample_profiles is None:
+        sample = pd.read_csv(dip.SAMPLE_DATASET_PATH)
+        intake = pd.to_datetime(sample['intake_date_time'], dayfirst=True)
+        outcome = pd.to_datetime(sample['outcome_date_time'], dayfirst=True)
+        _sample_profiles = {
+            'profiles': sample[PROFILE_COLUMNS].reset_index(drop=True),
+            'stay_minutes': ((outcome - intake).dt.total_seconds() // 60).to_numpy(dtype=np.int64),
+        }
+    return _sample_profiles
+
+# Day-first dates without zero padding on the day, month and hour, as in the sample
+def format_shelter_dates(dates):
+    return (dates.dt.day.astype(str) + '/' + dates.dt.month.astype(str) + '/' + dates.dt.year.astype(str) + ' '
+            + dates.dt.hour.astype(str) + ':' + dates.dt.minute.astype(str).str.zfill(2))
+
+def generate_shelter_data(num_rows, seed=0, first_animal_num=0):
+    rng = np.random.default_rng(seed)
+    sample = load_sample_profiles()
+
+    profile_rows = rng.integers(0, len(sample['profiles']), num_rows)
+
+    # Some records are repeat intakes, they reuse the id and profile of an earlier record
+    animal_nums = first_animal_num + np.arange(num_rows)
+    repeats = np.flatnonzero(rng.random(num_rows) < REPEAT_INTAKE_RATE)
+    repeats = repeats[repeats > 0]
+    earlier = rng.integers(0, repeats)
+    animal_nums[repeats] = animal_nums[earlier]
+    profile_rows[repeats] = profile_rows[earlier]
+    animal_ids = pd.Series(animal_nums).astype(str).str.zfill(6)
+
+    data = sample['profiles'].iloc[profile_rows].reset_index(drop=True)
+
+    intake_minutes = rng.integers(0, int((INTAKE_END - INTAKE_START).total_seconds() // 60), num_rows)
+    intake_dates = INTAKE_START + pd.to_timedelta(intake_minutes, unit='min')
+    outcome_dates = intake_dates + pd.to_timedelta(sample['stay_minutes'][profile_rows], unit='min')
+
+    data.insert(0, 'animal_id', 'A' + animal_ids)
+    data['intake_date_time'] = format_shelter_dates(pd.Series(intake_dates))
+    data['outcome_date_time'] = format_shelter_dates(pd.Series(outcome_dates))
+    return data[OUTPUT_COLUMNS]
+
+# Write num_rows records to a CSV in chunks, so memory use does not grow with the number of rows
+def write_shelter_data(path, num_rows, seed=0, chunk_rows=CHUNK_ROWS):
+    if os.path.exists(path):
+        os.remove(path)
+
+    for chunk_num, first_row in enumerate(range(0, num_rows, chunk_rows)):
+        chunk = generate_shelter_data(min(chunk_rows, num_rows - first_row), seed=[seed, chunk_num], first_animal_num=first_row)
+        chunk.to_csv(path, mode='a', header=first_row == 0, index=False)
+    return path
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Generate synthetic shelter records in the format of testing_sample_data.csv.')
+    arg_parser.add_argument('num_rows', type=int, help='number of records to generate')
+    arg_parser.add_argument('output_path', help='CSV file to write the records to')
+    arg_parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same file')
+    args = arg_parser.parse_args()
+
+    start_time = time.perf_counter()
+    write_shelter_data(args.output_path, args.num_rows, args.seed)
+    print(f'{args.num_rows} records written to {args.output_path} in {time.perf_counter() - start_time:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# The partitioned (parallel) cleaning pipeline must give the same cleaned data and shelter metrics as the
+# serial pipeline, on the whole sample dataset and on tiny uploads where most partitions end up empty
+# after filtering: an empty upload, a handful of rows, and records without any cats or dogs.
+import logging
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_functions as dip
+
+# Session state is not available outside `streamlit run`, so silence its warnings
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+pytestmark = pytest.mark.filterwarnings('ignore::pandas.errors.SettingWithCopyWarning')
+
+SAMPLE = pd.read_csv(dip.SAMPLE_DATASET_PATH, dtype=str)
+NOT_CATS_OR_DOGS = SAMPLE[~SAMPLE['animal_type'].str.lower().isin(dip.KPI_ANIMAL_TYPES)]
+
+INPUTS = {
+    'sample': SAMPLE,
+    'empty': SAMPLE.iloc[:0],
+    'first 1 row': SAMPLE.iloc[:1],
+    'first 5 rows': SAMPLE.iloc[:5],
+    'first 30 rows': SAMPLE.iloc[:30],
+    '30 random rows': SAMPLE.sample(30, random_state=0),
+    '200 random rows': SAMPLE.sample(200, random_state=0),
+    'no cats or dogs': NOT_CATS_OR_DOGS.head(50),
+}
+
+# (workers, number of partitions): one partition in this process, many small partitions in this process (one per
+# row on the tiny inputs), and many small partitions shared by a pool of worker processes
+PARTITIONINGS = {
+    'one partition': (1, 1),
+    'many partitions': (1, 30),
+    'many partitions, two worker processes': (2, 30),
+}
+
+
+def assert_same_cleaned_data(actual, expected):
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True), check_categorical=False)
+
+
+@pytest.fixture(autouse=True)
+def session_state(monkeypatch):
+    monkeypatch.setattr(dip.st, 'session_state', {})
+    return dip.st.session_state
+
+
+@pytest.mark.parametrize('partitioning', PARTITIONINGS)
+@pytest.mark.parametrize('input_name', INPUTS)
+def test_partitioned_matches_serial(input_name, partitioning, session_state):
+    data = INPUTS[input_name]
+    workers, num_partitions = PARTITIONINGS[partitioning]
+    partition_size = max(1, -(-len(data) // num_partitions))
+
+    expected, _ = dip.run_preprocessing_stages(data.copy())
+    expected_kpis = {key: session_state[key] for key in ['total_num_intakes', 'total_num_adoptions', 'save_rate', 'live_release_rate']}
+
+    actual, _, session_values = dip.partitioned_preprocessing(data.copy(), workers=workers, partition_size=partition_size)
+    assert_same_cleaned_data(actual, expected)
+    assert dip.kpi_totals(session_values['kpi_accumulator']) == pytest.approx(expected_kpis, nan_ok=True)